@@ -1,10 +1,60 @@
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import itertools
+import mmap
+import operator
+import os
+import re
 import sys
+import time
 import tpg
 import pdb
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 class AnalError(Exception):
     """Class of exceptions raised when an error occurs during analysis."""
 
+class EvalError(Exception):
+    """Class of exceptions raised when an error occurs during evaluation."""
+
+# Severity levels of the findings of the analyzers.
+ERROR, WARNING, INFO = 0, 1, 2
+
+# Findings are records (level, kind, names, node) in a preallocated buffer;
+# those above verbosity are dropped on the spot.
+class Diagnostics(object):
+    """Collector of the findings of the analyzers, printed by flush()."""
+
+    def __init__(self, verbosity=INFO, capacity=1024):
+        self.verbosity = verbosity
+        self.records = [None] * capacity
+        self.count = 0
+
+    def emit(self, level, node, kind, *names):
+        """Record a finding about node, unless verbosity filters it out."""
+        if level > self.verbosity: return
+        if self.count == len(self.records):
+            self.records.extend([None] * len(self.records))
+        self.records[self.count] = (level, kind, names, node)
+        self.count += 1
+
+    def __iter__(self):
+        return iter(self.records[:self.count])
+
+    def flush(self, out=None):
+        """Write the buffered records to out (stdout by default) and clear them."""
+        lines = [' '.join((kind,) + names) + '\n' for level, kind, names, node in self]
+        (out or sys.stdout).write(''.join(lines))
+        self.records[:self.count] = [None] * self.count
+        self.count = 0
+
+diagnostics = Diagnostics()
+
 # These are the classes of nodes of our abstract syntax trees (ASTs).
 
 class Node(object):
@@ -13,11 +63,27 @@ class Node(object):
     # For each class of nodes, store names of the fields for children nodes.
     fields = []
 
+    # Position of the node in the source, when the parser records it.
+    line = column = None
+
     def __init__(self, *args):
         """Populate fields named in "fields" with values in *args."""
         assert(len(self.fields) == len(args))
         for f, a in zip(self.fields, args): setattr(self, f, a)
 
+    def __getattr__(self, name):
+        """Decode the fields of a node loaded lazily from a serialized AST."""
+        if name in self.fields and 'serialized' in self.__dict__:
+            self.serialized[0].load(self)
+            return getattr(self, name)
+        raise AttributeError(name)
+
+    def compile_jump(self, code, sense, jumps):
+        """Append to code instructions which jump if the truth of this
+        expression is sense; add the positions of the jumps to jumps."""
+        jumps.append(len(code))
+        code.append((JUMP_IF_TRUE if sense else JUMP_IF_FALSE, self, None))
+
 # subclasses of Node for expressions
 
 class Var(Node):
@@ -28,8 +94,13 @@ class Var(Node):
     def anlz_procs_called(self):pass
     def anlz_vars(self,local_var_env,is_global):
         if self.name not in global_var_env | local_var_env:
-            print('Use of undeclared variable')
-        print('Use of variable ',self.name)
+            diagnostics.emit(ERROR, self, 'Use of undeclared variable')
+        diagnostics.emit(INFO, self, 'Use of variable ',self.name)
+    def evaluate(self, rt, env):
+        try: return env[self.name]
+        except KeyError: pass
+        try: return rt.globals[self.name]
+        except KeyError: raise EvalError('undefined variable %s' % self.name)
 class Int(Node):
     """Class of nodes representing integer literals."""
     fields = ['value']
@@ -37,6 +108,8 @@ class Int(Node):
         pass
     def anlz_procs_called(self):pass
     def anlz_vars(self,local_var_env,is_global):pass
+    def evaluate(self, rt, env):
+        return self.value
 class String(Node):
     """Class of nodes representing string literals."""
     fields = ['value']
@@ -44,41 +117,82 @@ class String(Node):
         pass
     def anlz_procs_called(self):pass
     def anlz_vars(self,local_var_env,is_global):pass
+    def evaluate(self, rt, env):
+        return self.value
 class Array(Node):
     """Class of nodes representing array literals."""
     fields = ['elements']
     def anlz_procs(self):
         pass
-    def anlz_procs_called(self):pass
+    def anlz_procs_called(self):
+        for e in self.elements:
+            e.anlz_procs_called()
     def anlz_vars(self,local_var_env,is_global):
         for e in self.elements:
             e.anlz_vars(local_var_env,is_global)
+    def evaluate(self, rt, env):
+        return make_array([e.evaluate(rt, env) for e in self.elements])
 class Index(Node):
     """Class of nodes representing indexed accesses of arrays or strings."""
     fields = ['indexable', 'index']
     def anlz_procs(self):
         pass
-    def anlz_procs_called(self):pass
+    def anlz_procs_called(self):
+        self.indexable.anlz_procs_called()
+        self.index.anlz_procs_called()
     def anlz_vars(self,local_var_env,is_global):
         self.indexable.anlz_vars(local_var_env,is_global)
         self.index.anlz_vars(local_var_env,is_global)
+    def evaluate(self, rt, env):
+        return index_value(self.indexable.evaluate(rt, env),
+                           self.index.evaluate(rt, env))
 class BinOpExp(Node):
     """Class of nodes representing binary-operation expressions."""
     fields = ['left', 'op', 'right']
     def anlz_procs(self):
         pass
-    def anlz_procs_called(self):pass
+    def anlz_procs_called(self):
+        self.left.anlz_procs_called()
+        self.right.anlz_procs_called()
     def anlz_vars(self,local_var_env,is_global):
         self.left.anlz_vars(local_var_env,is_global)
         self.right.anlz_vars(local_var_env,is_global)
+    def evaluate(self, rt, env):
+        if self.op == 'and':
+            return truth(self.left.evaluate(rt, env)) and truth(self.right.evaluate(rt, env))
+        if self.op == 'or':
+            return truth(self.left.evaluate(rt, env)) or truth(self.right.evaluate(rt, env))
+        return binop_value(self.op, self.left.evaluate(rt, env),
+                           self.right.evaluate(rt, env))
+    def compile_jump(self, code, sense, jumps):
+        if self.op in ('and', 'or'):
+            if (self.op == 'or') == sense:
+                # either operand alone decides the jump
+                self.left.compile_jump(code, sense, jumps)
+                self.right.compile_jump(code, sense, jumps)
+            else:
+                skip = []
+                self.left.compile_jump(code, not sense, skip)
+                self.right.compile_jump(code, sense, jumps)
+                patch(code, skip, len(code))
+        elif self.op in ('==', '<', '>'):
+            jumps.append(len(code))
+            code.append((COMPARE_JUMP, self.op, self.left, self.right, sense, None))
+        else:
+            Node.compile_jump(self, code, sense, jumps)
 class UniOpExp(Node):
     """Class of nodes representing unary-operation expressions."""
     fields = ['op', 'arg']
     def anlz_procs(self):
         pass
-    def anlz_procs_called(self):pass
+    def anlz_procs_called(self):
+        self.arg.anlz_procs_called()
     def anlz_vars(self,local_var_env,is_global):
         self.arg.anlz_vars(local_var_env,is_global)
+    def evaluate(self, rt, env):
+        return 1 - truth(self.arg.evaluate(rt, env))
+    def compile_jump(self, code, sense, jumps):
+        self.arg.compile_jump(code, not sense, jumps)
 # subclasses of Node for statements
 
 class Print(Node):
@@ -86,26 +200,38 @@ class Print(Node):
     fields = ['exp']
     def anlz_procs(self):
         pass
-    def anlz_procs_called(self):pass
+    def anlz_procs_called(self):
+        self.exp.anlz_procs_called()
     def anlz_vars(self,local_var_env,is_global):
         self.exp.anlz_vars(local_var_env,is_global)
+    def compile(self, code, tail, graph):
+        code.append((PRINT, self.exp))
 class Assign(Node):
     """Class of nodes representing assignment statements."""
     fields = ['left', 'right']
     def anlz_procs(self):
         pass    
-    def anlz_procs_called(self):pass
+    def anlz_procs_called(self):
+        self.left.anlz_procs_called()
+        self.right.anlz_procs_called()
     def anlz_vars(self,local_var_env,is_global):
         self.right.anlz_vars(local_var_env,is_global)
         if isinstance(self.left,Var):
             if is_global: global_var_env.add(self.left.name)
             else: local_var_env.add(self.left.name)
-            print('Definition of variable ',self.left.name)
+            diagnostics.emit(INFO, self, 'Definition of variable ',self.left.name)
             if not is_global and self.left.name in global_var_env:
-                print('Shadowing of global variable', self.left.name)
+                diagnostics.emit(WARNING, self, 'Shadowing of global variable', self.left.name)
         if isinstance(self.left,Index):
             self.left.anlz_vars(local_var_env,is_global)
-            
+    def compile(self, code, tail, graph):
+        if isinstance(self.left, Var):
+            code.append((ASSIGN, self.left.name, self.right))
+        elif isinstance(self.left, Index):
+            code.append((STORE, self.left.indexable, self.left.index, self.right))
+        else:
+            code.append((FAIL, 'cannot assign to this expression'))
+
 class Block(Node):
     """Class of nodes representing block statements."""
     fields = ['stmts']
@@ -118,54 +244,109 @@ class Block(Node):
     def anlz_vars(self,local_var_env,is_global):
         for s in self.stmts:
             s.anlz_vars(local_var_env,is_global)
+    def compile(self, code, tail, graph):
+        for i, s in enumerate(self.stmts):
+            s.compile(code, tail and i == len(self.stmts) - 1, graph)
 class If(Node):
     """Class of nodes representing if statements."""
     fields = ['exp', 'stmt']
     def anlz_procs(self):
         self.stmt.anlz_procs()
     def anlz_procs_called(self):
+        self.exp.anlz_procs_called()
         self.stmt.anlz_procs_called()
     def anlz_vars(self,local_var_env,is_global):
         self.exp.anlz_vars(local_var_env,is_global)
         self.stmt.anlz_vars(local_var_env,is_global)
+    def compile(self, code, tail, graph):
+        jumps = []
+        compile_condition(self.exp, code, False, jumps)
+        self.stmt.compile(code, tail, graph)
+        patch(code, jumps, len(code))
 class While(Node):
     """Class of nodes representing while statements."""
     fields = ['exp', 'stmt']
     def anlz_procs(self):
     	self.stmt.anlz_procs()
     def anlz_procs_called(self):
+        self.exp.anlz_procs_called()
         self.stmt.anlz_procs_called()
     def anlz_vars(self,local_var_env,is_global):
         self.exp.anlz_vars(local_var_env,is_global)
         self.stmt.anlz_vars(local_var_env,is_global)
+    def compile(self, code, tail, graph):
+        # the condition is tested at the bottom of the loop, so that an
+        # iteration runs a single jump
+        start = len(code)
+        code.append((HOIST, []))
+        code.append((JUMP, None))
+        body = len(code)
+        self.stmt.compile(code, False, graph)
+        patch(code, [body - 1], len(code))
+        jumps = []
+        compile_condition(self.exp, code, True, jumps)
+        patch(code, jumps, body)
+        code[start] = (HOIST, LoopInvariants(code, body, len(code), graph).hoist())
 class Def(Node):
     """Class of nodes representing procedure definitions."""
     fields = ['name', 'params', 'body']
+    def __init__(self, *args):
+        Node.__init__(self, *args)
+        if isinstance(self.body, SkimmedBody):
+            self.skimmed = self.__dict__.pop('body')
+    def __getattr__(self, name):
+        """Parse the body skimmed by a LazyParser when it is first used."""
+        if name == 'body' and 'skimmed' in self.__dict__:
+            self.body = self.__dict__.pop('skimmed').parse()
+            return self.body
+        return Node.__getattr__(self, name)
+    def parsed_body(self):
+        """Return the body, or an empty block while it is only skimmed;
+        the analyzers look at the bodies that were parsed only."""
+        if 'skimmed' in self.__dict__: return Block([])
+        return self.body
     def anlz_procs(self):
         if self.name in procs_defined:
-        	print('method already defined!')
-        print('Definition of procedure',self.name)
+        	diagnostics.emit(ERROR, self, 'method already defined!')
+        diagnostics.emit(INFO, self, 'Definition of procedure',self.name)
         procs_defined.add(self.name)
-        self.body.anlz_procs()
+        self.parsed_body().anlz_procs()
     def anlz_procs_called(self):
-        self.body.anlz_procs_called()
+        self.parsed_body().anlz_procs_called()
     def anlz_vars(self,local_var_env,is_global):
         new_local_var_env = set(self.params)
-        print('Locals of procedure', self.name+':', ', '.join(self.params))
+        diagnostics.emit(INFO, self, 'Locals of procedure', self.name+':', ', '.join(self.params))
         for v in new_local_var_env & global_var_env:
-            print('Shadowing of global variable',v)
-        self.body.anlz_vars(new_local_var_env,False)
+            diagnostics.emit(WARNING, self, 'Shadowing of global variable',v)
+        self.parsed_body().anlz_vars(new_local_var_env,False)
+    code = None     # instructions of the body, compiled on first call
+    def compile(self, code, tail, graph):
+        code.append((DEFINE, self))
 class Call(Node):
     """Class of nodes representing precedure calls."""
     fields = ['name', 'args']
     def anlz_procs(self):
         pass
     def anlz_procs_called(self):
-        print('Call of procedure ',self.name)
+        diagnostics.emit(INFO, self, 'Call of procedure ',self.name)
         procs_called.add(self.name)
+        for a in self.args:
+            a.anlz_procs_called()
     def anlz_vars(self,local_var_env,is_global):
         for a in self.args:
             a.anlz_vars(local_var_env,is_global)
+    # Inline cache of the callee: the Def node of the procedure (None for
+    # a builtin), valid while the procedures of the runtime have version.
+    version = None
+    target = None
+    def evaluate(self, rt, env):
+        if self.version != rt.version:
+            rt.resolve(self)
+        if self.target is not None:
+            raise EvalError('procedure %s has no value' % self.name)
+        return call_builtin(self.name, [a.evaluate(rt, env) for a in self.args])
+    def compile(self, code, tail, graph):
+        code.append((TAIL_CALL if tail else CALL, self))
 class Parser(tpg.Parser):
     r"""
     token int:         '\d+' ;
@@ -176,19 +357,19 @@ class Parser(tpg.Parser):
 
     START/s -> Stmt/s ;
 
-    Stmt/s ->
+    Stmt/s -> @t
     ( 'print' Exp/e ';'  $s = Print(e)$
-    | Exp/l '=(?!=)' Exp/r ';'  $ s = Assign(l, r) $
+    | Exp/l check $ self.assignable(l) $ '=(?!=)' Exp/r ';'  $ s = Assign(l, r) $
+    | Exp/l check $ isinstance(l, Call) $ ';'  $ s = l $
     | '\{'  $ s=[] $  ( Stmt/s2  $ s.append(s2) $  )* '\}'  $s = Block(s)$
     | 'if' '\(' Exp/e '\)' Stmt/s  $ s = If(e, s) $
     | 'while' '\(' Exp/e '\)' Stmt/s  $ s = While(e, s) $
     | 'def' ident/f '\('  $l=[]$  ( ident/i  $l.append(i)$
                                     ( ',' ident/i  $l.append(i)$  )*)? '\)'
-      Stmt/s2  $s=Def(f,l,s2)$
-    | ident/f '\('  $l=[]$  ( Exp/e  $l.append(e)$
-                              ( ',' Exp/e  $l.append(e)$  )*)? '\)' ';'
-      $s=Call(f,l)$
-    ) ;
+      Body/s2  $s=Def(f,l,s2)$
+    ) $ s = self.at(s, t) $ ;
+
+    Body/s -> Stmt/s ;
 
     Exp/e -> Or/e ;
     Or/e  -> And/e ( 'or'  And/e2  $e=BinOpExp(e,'or', e2)$  )* ;
@@ -203,51 +384,484 @@ class Parser(tpg.Parser):
     | string/s  $e=String(s[1:-1])$
     | '\['  $e=[]$  ( Exp  $e.append(Exp)$  ( ',' Exp  $e.append(Exp)$  )*)?
       '\]'  $e=Array(e)$
-    | ident     $e=Var(ident)$
+    | @t ident/f '\('  $l=[]$  ( Exp/a  $l.append(a)$
+                                 ( ',' Exp/a  $l.append(a)$  )*)? '\)'
+      $e=self.at(Call(f,l), t)$
+    | @t ident/f  $e=self.at(Var(f), t)$
     ;
     CmpOp/r -> '=='/r | '<'/r | '>'/r ;
     AddOp/r -> '\+'/r | '-'/r ;
     MulOp/r -> '\*'/r | '/'/r ;
     """
 
-def parse(code):
-    # This makes a parser object, which acts as a parsing function.
-    parser = Parser()
-    return parser(code)
+    def at(self, node, token):
+        """Record in node the position of token, where node starts."""
+        node.line, node.column = token.line, token.column
+        return node
+
+    def assignable(self, node):
+        """Return whether node is a variable or an element of one."""
+        while isinstance(node, Index): node = node.indexable
+        return isinstance(node, Var)
+
+def parse(code, cache_dir=None, cache_size=64 << 20, parser=None):
+    """Parse code with parser (a new Parser by default), through the
+    AST cache in cache_dir when it is given."""
+    if cache_dir is None:
+        # This makes a parser object, which acts as a parsing function.
+        if parser is None: parser = Parser()
+        return parser(code)
+    return ASTCache(cache_dir, cache_size).parse(code, parser)
+
+# Compact binary serialization of ASTs.  A serialized AST is the magic
+# b'MSA' and a version byte, followed by a table of the strings used
+# (identifiers and string literals) and by the root node.  A node is a
+# kind byte, the size in bytes of the rest of the node, the line and column
+# of the node and then its fields; sizes let a reader skip subtrees, so
+# that a memory-mapped AST can be walked lazily.  The high bit of the kind
+# tells whether the node has a position, and leaves, which are decoded as
+# fast as they are skipped, have no size.  Integers are varints (zigzag
+# for the values of Int nodes).
+
+AST_MAGIC, AST_VERSION = b'MSA', 4
+
+# For each class of nodes, the types of its fields: 'n' node, 'N' list of
+# nodes, 's' string, 'S' list of strings, 'i' integer.
+node_kinds = [(Var, 's'), (Int, 'i'), (String, 's'), (Array, 'N'),
+              (Index, 'nn'), (BinOpExp, 'nsn'), (UniOpExp, 'sn'),
+              (Print, 'n'), (Assign, 'nn'), (Block, 'N'), (If, 'nn'),
+              (While, 'nn'), (Def, 'sSn'), (Call, 'sN')]
+kind_of = dict((cls, k) for k, (cls, types) in enumerate(node_kinds))
+leaf_kinds = frozenset(k for k, (cls, types) in enumerate(node_kinds)
+                       if 'n' not in types and 'N' not in types)
+POSITIONED = 0x80
+
+def put_varint(out, n):
+    """Append the unsigned integer n to the bytearray out."""
+    while n > 0x7f:
+        out.append(n & 0x7f | 0x80)
+        n >>= 7
+    out.append(n)
+
+def put_varint_reversed(out, n):
+    """Append the unsigned integer n to the bytearray out, bytes reversed."""
+    if n < 0x80:
+        out.append(n)
+    else:
+        v = bytearray()
+        put_varint(v, n)
+        v.reverse()
+        out += v
+
+def get_varint(data, pos):
+    """Return the unsigned integer at data[pos] and the position after it."""
+    n = shift = 0
+    while True:
+        b = data[pos]
+        pos += 1
+        n |= (b & 0x7f) << shift
+        if b < 0x80: return n, pos
+        shift += 7
+
+def dump_ast(node):
+    """Serialize the AST node into bytes."""
+    strings = {}
+    def string(s):
+        i = strings.get(s)
+        if i is None: i = strings[s] = len(strings)
+        return i
+    # Nodes are written backwards, without recursion, into one buffer which
+    # is reversed at the end: the size of a node is known when its header is
+    # written.  todo holds nodes, varints, and the headers of started nodes.
+    body, todo = bytearray(), [node]
+    while todo:
+        x = todo.pop()
+        if type(x) is int:
+            if x < 0x80: body.append(x)
+            else: put_varint_reversed(body, x)
+        elif type(x) is tuple:
+            k, start, line, column = x
+            if line:
+                put_varint_reversed(body, column)
+                put_varint_reversed(body, line)
+                k |= POSITIONED
+            if k & ~POSITIONED not in leaf_kinds:
+                put_varint_reversed(body, len(body) - start)
+            body.append(k)
+        else:
+            k = kind_of[type(x)]
+            todo.append((k, len(body), x.line, x.column))
+            for f, t in zip(x.fields, node_kinds[k][1]):
+                v = getattr(x, f)
+                if t == 'n': todo.append(v)
+                elif t == 's': todo.append(string(v))
+                elif t == 'i': todo.append(v << 1 if v >= 0 else (-v << 1) - 1)
+                else:
+                    todo.append(len(v))
+                    for e in v: todo.append(e if t == 'N' else string(e))
+    body.reverse()
+    table = bytearray()
+    for s in strings:
+        s = s.encode('utf-8')
+        put_varint(table, len(s))
+        table += s
+    out = bytearray(AST_MAGIC)
+    out.append(AST_VERSION)
+    put_varint(out, len(strings))
+    put_varint(out, len(table))
+    return bytes(out + table + body)
+
+class ASTReader(object):
+    """Decoder of serialized ASTs held in bytes or in a memory map."""
+
+    def __init__(self, data):
+        data = memoryview(data)
+        if bytes(data[:3]) != AST_MAGIC or data[3] != AST_VERSION:
+            raise ValueError('not a serialized AST (version %d)' % AST_VERSION)
+        self.data = data
+        n, pos = get_varint(data, 4)
+        size, pos = get_varint(data, pos)
+        self.string_pos, self.root = pos, pos + size
+        self.strings = [None] * n
+        self.offsets = None
+
+    def string(self, i):
+        s = self.strings[i]
+        if s is None:
+            if self.offsets is None:
+                # one pass over the table to find where each string starts
+                self.offsets, pos = [], self.string_pos
+                for _ in self.strings:
+                    size, start = get_varint(self.data, pos)
+                    self.offsets.append((start, start + size))
+                    pos = start + size
+            start, stop = self.offsets[i]
+            s = self.strings[i] = str(self.data[start:stop], 'utf-8')
+        return s
+
+    def fields(self, types, pos, node):
+        """Decode fields of types at pos, building children with node();
+        return them and the position after them."""
+        data, args = self.data, []
+        for t in types:
+            if t == 'n':
+                v, pos = node(pos)
+            elif t == 's':
+                v, pos = get_varint(data, pos)
+                v = self.string(v)
+            elif t == 'i':
+                v, pos = get_varint(data, pos)
+                v = -((v + 1) >> 1) if v & 1 else v >> 1
+            else:
+                size, pos = get_varint(data, pos)
+                v = []
+                for _ in range(size):
+                    if t == 'N':
+                        x, pos = node(pos)
+                    else:
+                        x, pos = get_varint(data, pos)
+                        x = self.string(x)
+                    v.append(x)
+            args.append(v)
+        return args, pos
+
+    def header(self, pos):
+        """Return the kind, end (None for leaves), line, column and
+        position of the fields of the node at pos."""
+        data = self.data
+        k, pos, end, line, column = data[pos], pos + 1, None, None, None
+        if k & ~POSITIONED not in leaf_kinds:
+            size, pos = get_varint(data, pos)
+            end = pos + size
+        if k & POSITIONED:
+            line, pos = get_varint(data, pos)
+            column, pos = get_varint(data, pos)
+        return k & ~POSITIONED, end, line, column, pos
+
+    def node(self, pos):
+        """Decode the whole subtree at pos; return it and the position after."""
+        k, end, line, column, pos = self.header(pos)
+        cls, types = node_kinds[k]
+        args, pos = self.fields(types, pos, self.node)
+        node = cls(*args)
+        if line: node.line, node.column = line, column
+        return node, pos
+
+    def lazy(self, pos):
+        """Return a node for the subtree at pos, without decoding its fields."""
+        k, end, line, column, start = self.header(pos)
+        if end is None: return self.node(pos)
+        node = Node.__new__(node_kinds[k][0])
+        if line: node.line, node.column = line, column
+        node.serialized = (self, start)
+        return node, end
 
+    def load(self, node):
+        """Decode the fields of a node returned by lazy()."""
+        pos = node.__dict__.pop('serialized')[1]
+        types = node_kinds[kind_of[type(node)]][1]
+        args, pos = self.fields(types, pos, self.lazy)
+        for f, a in zip(node.fields, args):
+            setattr(node, f, a)
+
+def load_ast(data, lazy=False):
+    """Rebuild an AST from the bytes produced by dump_ast, lazily if lazy."""
+    reader = ASTReader(data)
+    node, pos = (reader.lazy if lazy else reader.node)(reader.root)
+    if pos != len(reader.data):
+        raise ValueError('trailing data after serialized AST')
+    return node
+
+def open_ast(path):
+    """Memory-map the serialized AST in path and return it as a lazy AST."""
+    with open(path, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return load_ast(data, lazy=True)
+
+# Entries are serialized ASTs, which hits open lazily (see open_ast).  Hits
+# refresh the mtime of their entry, which is what the LRU eviction goes by.
+class ASTCache(object):
+    """On-disk cache of parsed programs, keyed by a hash of their source."""
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+
+    def key(self, code, parser):
+        h = hashlib.sha256()
+        # a change of grammar, of parser or of serialization format
+        # invalidates entries
+        h.update(b'%s %d\0' % (AST_MAGIC, AST_VERSION))
+        h.update(type(parser).__name__.encode('utf-8') + b'\0')
+        h.update(Parser.__doc__.encode('utf-8'))
+        h.update(code.encode('utf-8') if isinstance(code, str) else code)
+        return os.path.join(self.directory, h.hexdigest() + '.msa')
+
+    def parse(self, code, parser=None):
+        if parser is None: parser = Parser()
+        path = self.key(code, parser)
+        try:
+            node = open_ast(path)
+            os.utime(path)
+            return node
+        except (OSError, ValueError, IndexError):
+            pass
+        node = parser(code)
+        # serializing the tree of a LazyParser would parse all its bodies
+        if not isinstance(parser, LazyParser):
+            self.store(path, dump_ast(node))
+        return node
+
+    def store(self, path, data):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            tmp = '%s.%d.tmp' % (path, os.getpid())
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+            self.evict()
+        except OSError:
+            pass            # caching is best effort
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits max_size."""
+        entries, total = [], 0
+        for e in os.scandir(self.directory):
+            if e.name.endswith('.msa'):
+                st = e.stat()
+                entries.append((st.st_mtime, st.st_size, e.path))
+                total += st.st_size
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_size: break
+            try: os.remove(path)
+            except OSError: continue
+            total -= size
+
+# Parallel parsing.  Big programs are one top-level block of many
+# statements.  A prescan finds where these statements end, following braces
+# but skipping strings and comments, which are the only tokens that may hold
+# braces or semicolons.  Runs of statements are then parsed from the Stmt
+# axiom in worker processes, each run padded so that its tokens keep their
+# lines and columns, and they come back as serialized ASTs.
+
+stmt_end_re = re.compile(r'"[^"]*"|#.*|[{};]')
+separators_re = re.compile(r'(?:\s+|#.*)*')
+
+run_parser = None   # parser of the runs in a worker process
+
+def parse_run(run):
+    """Parse a padded run of statements into a serialized Block, or return
+    None when it does not parse."""
+    global run_parser
+    if run_parser is None: run_parser = Parser()
+    try:
+        return dump_ast(run_parser.parse('Stmt', run))
+    except tpg.Error:
+        return None
+
+# Programs smaller than min_size, which are not a block, or which do not
+# parse, are parsed in this process, so that errors are reported as by Parser.
+class ParallelParser(object):
+    """Parser of big programs, which parses the statements of their
+    top-level block in a pool of jobs worker processes."""
+
+    def __init__(self, jobs=None, min_size=1 << 16):
+        self.jobs = jobs or os.cpu_count() or 1
+        self.min_size = min_size
+
+    def __call__(self, code):
+        split = self.split(code)
+        if split is not None:
+            (line, column), runs = split
+            with ProcessPoolExecutor(self.jobs) as pool:
+                blocks = list(pool.map(parse_run, runs))
+            if None not in blocks:
+                node = Block([s for b in blocks for s in load_ast(b).stmts])
+                node.line, node.column = line, column
+                return node
+        return Parser()(code)
+
+    def split(self, code):
+        """Return the position of the top-level block of code and its
+        statements cut into padded runs, or None."""
+        if len(code) < self.min_size: return None
+        top = separators_re.match(code).end()
+        if not code.startswith('{', top): return None
+        size = max(len(code) // (self.jobs * 4), 1)
+        runs, depth, start = [], 0, top + 1
+        for m in stmt_end_re.finditer(code, top):
+            c = m.group()
+            if c == '{': depth += 1
+            elif c == '}': depth -= 1
+            elif c != ';': continue
+            if depth == 1 and m.end() - start >= size:
+                runs.append((start, m.end()))
+                start = m.end()
+            elif depth == 0: break
+        else:
+            return None
+        if separators_re.match(code, m.end()).end() != len(code): return None
+        runs.append((start, m.start()))
+        if len(runs) < 2: return None
+        padded, line, pos = [], 1, 0
+        for start, end in runs:
+            line += code.count('\n', pos, start)
+            column, pos = start - code.rfind('\n', 0, start), start
+            padded.append('\n' * (line - 1) + '{' + ' ' * (column - 2) +
+                          code[start:end] + '}')
+        line = code.count('\n', 0, top) + 1
+        return (line, top - code.rfind('\n', 0, top)), padded
+
+# Lazy parsing.  A LazyParser only skims the braced bodies of procedure
+# definitions, matching their braces while skipping strings and comments as
+# the prescan of parallel parsing does; a body is parsed the first time it
+# is used, by analysis or execution.
+
+class SkimmedBody(object):
+    """Source of a procedure body skimmed by parser, at line and column."""
+
+    def __init__(self, parser, text, line, column):
+        self.parser = parser
+        self.text, self.line, self.column = text, line, column
+
+    def parse(self):
+        # padding keeps the lines and columns of the tokens of the body
+        return self.parser.parse('Stmt', '\n' * (self.line - 1) +
+                                 ' ' * (self.column - 1) + self.text)
+
+brace_re = re.compile(r'"[^"]*"|#.*|(\{)|(\})')
+
+class LazyParser(Parser):
+    # Parser of programs whose procedure bodies are parsed on first use.
+    # Syntax errors in a body are only raised then.  (A doc string would be
+    # taken for a grammar by tpg.)
+
+    def Body(self):
+        lexer = self.lexer
+        token = lexer.cur_token
+        if token.text != '{': return Parser.Body(self)
+        input = lexer.input
+        depth = 0
+        for m in brace_re.finditer(input, token.start):
+            if m.lastindex == 1: depth += 1
+            elif m.lastindex == 2:
+                depth -= 1
+                if depth == 0: break
+        else:
+            return Parser.Body(self)    # unbalanced: report the error now
+        # lex again from the closing brace, past it
+        close = m.start()
+        nl = input.rfind('\n', token.start, close)
+        lexer.pos = close
+        lexer.line = token.line + input.count('\n', token.start, close)
+        lexer.column = close - nl if nl > -1 else token.column + close - token.start
+        lexer.next_token()
+        lexer.next_token()
+        return SkimmedBody(self, input[token.start:m.end()],
+                           token.line, token.column)
 
 def anlz_procs_imp(node):
     """Analyze procedure definitions and calls."""
-    if isinstance(node, (Print, Assign)): pass
+    if isinstance(node, (Var, Int, String)): pass
+    elif isinstance(node, Array):
+        for e in node.elements: anlz_procs_imp(e)
+    elif isinstance(node, Index):
+        anlz_procs_imp(node.indexable)
+        anlz_procs_imp(node.index)
+    elif isinstance(node, BinOpExp):
+        anlz_procs_imp(node.left)
+        anlz_procs_imp(node.right)
+    elif isinstance(node, UniOpExp):
+        anlz_procs_imp(node.arg)
+    elif isinstance(node, Print):
+        anlz_procs_imp(node.exp)
+    elif isinstance(node, Assign):
+        anlz_procs_imp(node.left)
+        anlz_procs_imp(node.right)
     elif isinstance(node, Block):
         for s in node.stmts: anlz_procs_imp(s)
     elif isinstance(node, (If, While)):
+        anlz_procs_imp(node.exp)
         anlz_procs_imp(node.stmt)
     elif isinstance(node, Def):
         if node.name in proc_defined: 
         	try:
         		raise AnalError()
         	except AnalError:
-        		print('Error4')
-        print('Definition of procedure', node.name)
+        		diagnostics.emit(ERROR, node, 'Error4')
+        diagnostics.emit(INFO, node, 'Definition of procedure', node.name)
         proc_defined.add(node.name)
-        anlz_procs_imp(node.body)
+        anlz_procs_imp(node.parsed_body())
     elif isinstance(node, Call):
-        print('Call of procedure', node.name)
+        diagnostics.emit(INFO, node, 'Call of procedure', node.name)
         proc_called.add(node.name)
+        for a in node.args: anlz_procs_imp(a)
     else: 
     	try:
     		raise Exception("Not implemented.")
     	except Exception:
-    		print('Oops! analysis error.')
+    		diagnostics.emit(ERROR, node, 'Oops! analysis error.')
     
 def anlz_procs_fun(node,procs_defined,procs_called):
-	if isinstance(node,(Print,Assign)):
+	if isinstance(node,(Var,Int,String)):
 		return set(),set()
+	elif isinstance(node,Array):
+		return a_list_p_fun(node.elements,procs_defined,procs_called,0)
+	elif isinstance(node,Index):
+		return a_list_p_fun([node.indexable,node.index],procs_defined,procs_called,0)
+	elif isinstance(node,BinOpExp):
+		return a_list_p_fun([node.left,node.right],procs_defined,procs_called,0)
+	elif isinstance(node,UniOpExp):
+		return anlz_procs_fun(node.arg,procs_defined,procs_called)
+	elif isinstance(node,Print):
+		return anlz_procs_fun(node.exp,procs_defined,procs_called)
+	elif isinstance(node,Assign):
+		return a_list_p_fun([node.left,node.right],procs_defined,procs_called,0)
 	elif isinstance(node,Block):
 		return a_block_p_fun(node,procs_defined,procs_called,0)
 	elif isinstance(node,(If,While)):
-		return anlz_procs_fun(node.stmt,procs_defined,procs_called)
+		return a_list_p_fun([node.exp,node.stmt],procs_defined,procs_called,0)
 	elif isinstance(node,Def):
 		return a_def_p_fun(node,procs_defined,procs_called)
 	elif isinstance(node,Call):
@@ -263,21 +877,30 @@ def a_block_p_fun(node,procs_defined,procs_called,x):
 		c,d = a_block_p_fun(node,procs_defined,procs_called,x+1)
 		return a|c,b|d
 
+def a_list_p_fun(nodes,procs_defined,procs_called,x):
+	if x == len(nodes):
+		return set(),set()
+	else:
+		a,b=anlz_procs_fun(nodes[x],procs_defined,procs_called)
+		c,d = a_list_p_fun(nodes,procs_defined,procs_called,x+1)
+		return a|c,b|d
+
 def a_def_p_fun(node,procs_defined,procs_called):
-	if node.name in procs_defined: print('Error2')
-	print('Definition of procedure',node.name)
-	return set([node.name]) | anlz_procs_fun(node.body,procs_defined,procs_called)[0],procs_called
+	if node.name in procs_defined: diagnostics.emit(ERROR, node, 'Error2')
+	diagnostics.emit(INFO, node, 'Definition of procedure',node.name)
+	return set([node.name]) | anlz_procs_fun(node.parsed_body(),procs_defined,procs_called)[0],procs_called
 
 
 def a_call_p_fun(node,procs_defined,procs_called):
-	print('Call of procedure', node.name)
-	return procs_defined,procs_called | set([node.name])
+	diagnostics.emit(INFO, node, 'Call of procedure', node.name)
+	a,b = a_list_p_fun(node.args,procs_defined,procs_called,0)
+	return procs_defined|a,procs_called | set([node.name]) | b
 
 def anlz_vars_imp(node, local_var_env, is_global):
     """Analyze variable definitions and uses."""
     if isinstance(node, Var):
-        if node.name not in local_var_env | global_var_env: print('Error3')
-        print('Use of variable', node.name)
+        if node.name not in local_var_env | global_var_env: diagnostics.emit(ERROR, node, 'Error3')
+        diagnostics.emit(INFO, node, 'Use of variable', node.name)
     elif isinstance(node, (Int, String)): pass
     elif isinstance(node, Array):
         for e in node.elements: anlz_vars_imp(e, local_var_env, is_global)
@@ -296,9 +919,9 @@ def anlz_vars_imp(node, local_var_env, is_global):
         if isinstance(node.left, Var):
             if is_global: global_var_env.add(node.left.name)
             else: local_var_env.add(node.left.name)
-            print('Definition of variable', node.left.name)
+            diagnostics.emit(INFO, node, 'Definition of variable', node.left.name)
             if not is_global and node.left.name in global_var_env:
-                print('Shadowing of global variable', node.left.name)
+                diagnostics.emit(WARNING, node, 'Shadowing of global variable', node.left.name)
         if isinstance(node.left, Index):
             anlz_vars_imp(node.left, local_var_env, is_global)
     elif isinstance(node, Block):
@@ -308,23 +931,23 @@ def anlz_vars_imp(node, local_var_env, is_global):
         anlz_vars_imp(node.stmt, local_var_env, is_global)
     elif isinstance(node, Def):
         new_local_var_env = set(node.params)
-        print('Locals of procedure', node.name+':', ', '.join(node.params))
+        diagnostics.emit(INFO, node, 'Locals of procedure', node.name+':', ', '.join(node.params))
         for v in new_local_var_env & global_var_env:
         #& is intersection | is union of sets y = set(iterable)
-            print('Shadowing of global variable', v)
-        anlz_vars_imp(node.body, new_local_var_env, False)
+            diagnostics.emit(WARNING, node, 'Shadowing of global variable', v)
+        anlz_vars_imp(node.parsed_body(), new_local_var_env, False)
     elif isinstance(node, Call):
         for a in node.args: anlz_vars_imp(a, local_var_env, is_global)
     else: 
     	try:
     		raise Exception("Not implemented.!")
     	except Exception:
-    		print('Oops. that is not supported@')
+    		diagnostics.emit(ERROR, node, 'Oops. that is not supported@')
 	
 def anlz_vars_fun(node,global_var_env,local_var_env,is_global):
 	if isinstance(node,Var):
-		if node.name not in global_var_env | local_var_env:print('Error1')
-		print('Use of variable ',node.name)
+		if node.name not in global_var_env | local_var_env:diagnostics.emit(ERROR, node, 'Error1')
+		diagnostics.emit(INFO, node, 'Use of variable ',node.name)
 		return set(),set()
 	elif isinstance(node,(Int,String)):
 		return set(),set()
@@ -346,9 +969,9 @@ def anlz_vars_fun(node,global_var_env,local_var_env,is_global):
 		#pdb.set_trace()
 		a,b = anlz_vars_fun(node.right,global_var_env,local_var_env,is_global)
 		if isinstance(node.left,Var):
-			print('Definition of variable', node.left.name)
+			diagnostics.emit(INFO, node, 'Definition of variable', node.left.name)
 			if not is_global and node.left.name in global_var_env:
-				print('Shadowing of global variable', node.left.name)
+				diagnostics.emit(WARNING, node, 'Shadowing of global variable', node.left.name)
 			if is_global:
 				return a|{node.left.name}, b
 			else:
@@ -368,12 +991,12 @@ def anlz_vars_fun(node,global_var_env,local_var_env,is_global):
 	elif isinstance(node,Def):
 		#pdb.set_trace()
 		new_local_var_env = set(node.params)
-		print('Locals of procedure',node.name+':',', '.join(node.params))
+		diagnostics.emit(INFO, node, 'Locals of procedure',node.name+':',', '.join(node.params))
 		a_def_v_p(new_local_var_env&global_var_env,0)
-		return anlz_vars_fun(node.body,global_var_env,new_local_var_env|set(node.params),False)
+		return anlz_vars_fun(node.parsed_body(),global_var_env,new_local_var_env|set(node.params),False)
 	elif isinstance(node,Call):
 		return a_call_v_p(node,global_var_env,local_var_env,is_global,0)
-	else:print('Error7')
+	else:diagnostics.emit(ERROR, node, 'Error7')
 			
 def a_call_v_p(node,global_var_env,local_var_env,is_global,x):
 	if x == len(node.args):
@@ -387,7 +1010,7 @@ def a_def_v_p(a,x):
 	if x == len(a):
 		return
 	else:
-		print('Shadowing of global variable',a[x])
+		diagnostics.emit(WARNING, None, 'Shadowing of global variable',a[x])
 		a_def_v_p(a,x+1)
 def a_block_v_f(node,global_var_env,local_var_env,is_global,x):
 	if x == len(node.stmts):
@@ -404,35 +1027,915 @@ def a_array_v_f(node,global_var_env,local_var_env,is_global,x):
 		a,b = anlz_vars_fun(node.elements[x],global_var_env,local_var_env,is_global)
 		c,d= a_array_v_f(node,global_var_env|a,b|local_var_env,is_global,x+1)
 		return a|c,b|d
-		
-# Below is the driver code, which parses a given MustScript program
-# and analyzes the definitions and uses of procedures and variables
 
-# Open the input file, and read in the input program.
-prog = open(sys.argv[1]).read()
+# The key None stands for the top-level program.  The body of a procedure is
+# only walked once the procedure is found live, so that a LazyParser parses
+# only the bodies of the procedures that may run.
+class CallGraph(object):
+    """Index of the procedures of a program: their callers and
+    callees, recursive components, free variables and purity."""
 
-try:
-    # Try to parse the program.
-    print('Parsing...')
-    node = parse(prog)
+    def __init__(self, node):
+        self.defs = {}              # procedure -> its Def nodes
+        self.callees = {None: set()}
+        self.callers = {}
+        self.reads = {}             # procedure -> variables read
+        self.assigned = {}          # procedure -> parameters and variables assigned
+        self.stores = set()         # procedures storing into arrays or defining procedures
+        self.bodies = {}            # procedure -> Def nodes whose bodies are not walked
+        self.live = set()
+        self.anlz(node, None)
+        self.reach(self.callees[None])
+        self.free_vars = dict((p, self.reads[p] - self.assigned[p])
+                              for p in self.reads)
+        self.sccs, self.recursive = self.anlz_sccs()
+        self.pure = self.anlz_purity()
+
+    def anlz(self, node, owner):
+        """Record the calls and variable accesses of node, found in owner."""
+        if isinstance(node, Var):
+            if owner is not None: self.reads[owner].add(node.name)
+        elif isinstance(node, Array):
+            for e in node.elements: self.anlz(e, owner)
+        elif isinstance(node, Index):
+            self.anlz(node.indexable, owner)
+            self.anlz(node.index, owner)
+        elif isinstance(node, BinOpExp):
+            self.anlz(node.left, owner)
+            self.anlz(node.right, owner)
+        elif isinstance(node, UniOpExp):
+            self.anlz(node.arg, owner)
+        elif isinstance(node, Print):
+            self.anlz(node.exp, owner)
+        elif isinstance(node, Assign):
+            self.anlz(node.right, owner)
+            if owner is None:
+                self.anlz(node.left, owner)
+            elif isinstance(node.left, Var):
+                self.assigned[owner].add(node.left.name)
+            else:
+                self.stores.add(owner)
+                self.anlz(node.left, owner)
+        elif isinstance(node, Block):
+            for s in node.stmts: self.anlz(s, owner)
+        elif isinstance(node, (If, While)):
+            self.anlz(node.exp, owner)
+            self.anlz(node.stmt, owner)
+        elif isinstance(node, Def):
+            if owner is not None: self.stores.add(owner)
+            self.defs.setdefault(node.name, []).append(node)
+            self.callees.setdefault(node.name, set())
+            self.bodies.setdefault(node.name, []).append(node)
+            if node.name in self.live: self.reach([node.name])
+        elif isinstance(node, Call):
+            self.callees.setdefault(owner, set()).add(node.name)
+            self.callers.setdefault(node.name, set()).add(owner)
+            for a in node.args: self.anlz(a, owner)
+
+    def reach(self, procs):
+        """Add to live the procedures reachable from the procedures procs,
+        walking their bodies on the way."""
+        todo = list(procs)
+        while todo:
+            p = todo.pop()
+            self.live.add(p)
+            for proc in self.bodies.pop(p, ()):
+                self.reads.setdefault(p, set())
+                self.assigned.setdefault(p, set()).update(proc.params)
+                self.anlz(proc.body, p)
+            todo.extend(q for q in self.callees.get(p, ()) if q not in self.live)
+
+    def anlz_sccs(self):
+        """Return the strongly connected components of the live procedures,
+        callees first (Tarjan), and the set of the recursive procedures."""
+        index, low, stack, on_stack = {}, {}, [], set()
+        sccs, recursive = [], set()
+        for root in self.live:
+            if root in index or root not in self.defs: continue
+            work = [(root, iter(self.callees[root]))]
+            index[root] = low[root] = len(index)
+            stack.append(root); on_stack.add(root)
+            while work:
+                p, it = work[-1]
+                for q in it:
+                    if q not in self.defs: continue
+                    if q not in index:
+                        index[q] = low[q] = len(index)
+                        stack.append(q); on_stack.add(q)
+                        work.append((q, iter(self.callees[q])))
+                        break
+                    elif q in on_stack:
+                        low[p] = min(low[p], index[q])
+                else:
+                    work.pop()
+                    if work: low[work[-1][0]] = min(low[work[-1][0]], low[p])
+                    if low[p] == index[p]:
+                        scc = set()
+                        while True:
+                            q = stack.pop(); on_stack.discard(q); scc.add(q)
+                            if q == p: break
+                        scc = frozenset(scc)
+                        sccs.append(scc)
+                        if len(scc) > 1 or p in self.callees[p]:
+                            recursive |= scc
+        return sccs, recursive
+
+    def anlz_purity(self):
+        """Return the set of the procedures which store into no array and
+        define no procedure, nor call any which does."""
+        pure = set()
+        for scc in self.sccs:
+            if all(p not in self.stores and
+                   all(q in scc or q in pure or q not in self.defs and
+                       q in builtins and q not in mutating_builtins
+                       for q in self.callees[p])
+                   for p in scc):
+                pure |= scc
+        return pure
 
-    # Try to analyze the program.
-    print('Analyzing...')
+    def definition(self, proc):
+        """Return the last Def node defining proc, or None."""
+        defs = self.defs.get(proc)
+        return defs[-1] if defs else None
+
+    def is_recursive(self, proc):
+        """Return True if proc can (indirectly) call itself."""
+        return proc in self.recursive
+
+    def globals_read(self, proc):
+        """Return the variables read by proc that it never assigns."""
+        return self.free_vars.get(proc, frozenset())
+
+    def is_pure(self, proc):
+        """Return True if calling proc stores into no array."""
+        if proc in self.defs: return proc in self.pure
+        return proc in builtins and proc not in mutating_builtins
+
+    def prune(self):
+        """Drop the procedures that are not live, as prune_procs does."""
+        live = self.live
+        self.callees = dict((p, qs) for p, qs in self.callees.items()
+                            if p is None or p in live)
+        self.callers = dict((q, set(p for p in ps if p is None or p in live))
+                            for q, ps in self.callers.items() if q in live)
+        self.defs = dict((p, ds) for p, ds in self.defs.items() if p in live)
+        self.bodies = {}
+
+def call_graph(node):
+    """Return the call graph of the program node, built once and cached on node."""
+    graph = getattr(node, 'call_graph', None)
+    if graph is None:
+        graph = node.call_graph = CallGraph(node)
+    return graph
+
+def prune_procs(node, live):
+    """Drop, in place, the definitions of procedures that are not in live."""
+    if isinstance(node, Block):
+        node.stmts = [prune_procs(s, live) for s in node.stmts
+                      if not isinstance(s, Def) or s.name in live]
+    elif isinstance(node, (If, While)):
+        if isinstance(node.stmt, Def) and node.stmt.name not in live:
+            node.stmt = Block([])
+        else:
+            prune_procs(node.stmt, live)
+    elif isinstance(node, Def) and node.name in live:
+        prune_procs(node.body, live)
+    return node
+
+def eliminate_dead_procs(node):
+    """Remove the procedures that can never be called when running node."""
+    graph = call_graph(node)
+    prune_procs(node, graph.live)
+    graph.prune()
+    return node
+
+# Evaluation.  Values of MustScript are Python ints and strs, and arrays
+# (ArrayValue); the booleans produced by comparisons and logical operators
+# are 1 and 0.
+
+# Arrays holding only integers that fit in 64 bits are stored densely in an
+# array('q'), other arrays in a list.  An array switches to a list in place
+# as soon as it is given an element that does not fit, so that every
+# reference to it sees the change.
+class ArrayValue(object):
+    """MustScript array."""
+
+    __slots__ = ['data']
+
+    def __init__(self, data):
+        self.data = data
+
+    def __len__(self):
+        return len(self.data)
+
+    def __eq__(self, other):
+        if type(other) is not ArrayValue: return False
+        a, b = self.data, other.data
+        if type(a) is not type(b): a, b = list(a), list(b)
+        return a == b
+
+    __hash__ = None
+
+    def __repr__(self):
+        if type(self.data) is array:
+            return '[' + ', '.join(map(str, self.data)) + ']'
+        return repr(self.data)
+
+    def store(self, index, value):
+        try:
+            self.data[index] = value
+        except (TypeError, OverflowError):
+            self.data = list(self.data)
+            self.data[index] = value
+
+def make_array(values):
+    """Return an ArrayValue holding the list values."""
+    try:
+        return ArrayValue(array('q', values))
+    except (TypeError, OverflowError):
+        return ArrayValue(values)
+
+def truth(value):
+    """Return 1 if the integer value is true, 0 otherwise."""
+    if type(value) is not int:
+        raise EvalError('condition is not an integer')
+    return 1 if value else 0
+
+def binop_value(op, a, b):
+    """Return the value of the binary operation op (but and, or) on a and b."""
+    ta, tb = type(a), type(b)
+    if op == '+':
+        if ta is tb and ta in (int, str): return a + b
+        if ta is tb is ArrayValue:
+            if type(a.data) is type(b.data): return ArrayValue(a.data + b.data)
+            return ArrayValue(list(a.data) + list(b.data))
+    elif op in ('-', '*', '/'):
+        if ta is int and tb is int:
+            if op == '-': return a - b
+            if op == '*': return a * b
+            if b == 0: raise EvalError('division by zero')
+            return a // b
+    elif op == '==':
+        return 1 if a == b else 0
+    elif op in ('<', '>'):
+        if ta is tb and ta in (int, str):
+            return 1 if (a < b if op == '<' else a > b) else 0
+    raise EvalError('invalid operands for %s' % op)
+
+def index_value(indexable, index):
+    """Return indexable[index] for an array or a string."""
+    if type(index) is not int:
+        raise EvalError('invalid indexing')
+    if type(indexable) is ArrayValue:
+        indexable = indexable.data
+    elif type(indexable) is not str:
+        raise EvalError('invalid indexing')
+    if not 0 <= index < len(indexable):
+        raise EvalError('index out of range')
+    return indexable[index]
+
+def store_index(array, index, value):
+    """Perform array[index] = value."""
+    if type(array) is not ArrayValue or type(index) is not int:
+        raise EvalError('invalid indexed assignment')
+    if not 0 <= index < len(array.data):
+        raise EvalError('index out of range')
+    array.store(index, value)
+
+def format_value(value):
+    """Return the text printed for value: arrays print as Python lists."""
+    if type(value) is str: return value
+    return str(value) if type(value) is int else repr(value)
+
+class Output(object):
+    """Output channel of print statements, buffered before being
+    written to sink, or captured in memory without a sink."""
+
+    def __init__(self, sink=None, buffer_size=1 << 16):
+        self.sink = sink
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.size = 0
+        self.captured = []
+
+    def write_value(self, value):
+        """Print value on a line of its own."""
+        text = format_value(value)
+        self.buffer.append(text)
+        self.buffer.append('\n')
+        self.size += len(text) + 1
+        if self.size >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """Hand the buffered output over to the sink."""
+        if not self.buffer: return
+        text = ''.join(self.buffer)
+        self.buffer, self.size = [], 0
+        if self.sink is None:
+            self.captured.append(text)
+        else:
+            self.sink.write(text)
+            if hasattr(self.sink, 'flush'): self.sink.flush()
+
+    def getvalue(self):
+        """Return the output captured so far (without a sink)."""
+        self.flush()
+        return ''.join(self.captured)
+
+# Builtin procedures.  They are called like procedures, and also inside
+# expressions, where a call yields the result of the builtin.  The array
+# kernels run on NumPy over dense arrays when NumPy is available.
+
+NUMPY_MIN_SIZE = 64     # below this, NumPy costs more than it saves
+
+def int_array(value):
+    """Return the elements of value, which must be an array of integers."""
+    if type(value) is not ArrayValue:
+        raise EvalError('array expected')
+    data = value.data
+    if type(data) is not array and any(type(x) is not int for x in data):
+        raise EvalError('array of integers expected')
+    return data
+
+def as_numpy(data):
+    """Return data as an int64 NumPy array sharing its buffer, or None."""
+    if numpy is None or type(data) is not array or len(data) < NUMPY_MIN_SIZE:
+        return None
+    return numpy.frombuffer(data, dtype=numpy.int64)
+
+def magnitude(v):
+    """Return the greatest absolute value in the NumPy array v."""
+    return max(int(v.max()), -int(v.min()))
+
+def from_numpy(v):
+    """Return the int64 NumPy array v as a dense ArrayValue."""
+    data = array('q')
+    data.frombytes(v.tobytes())
+    return ArrayValue(data)
+
+def builtin_len(a):
+    if type(a) is str: return len(a)
+    if type(a) is not ArrayValue: raise EvalError('array or string expected')
+    return len(a.data)
+
+def builtin_sum(a):
+    data = int_array(a)
+    v = as_numpy(data)
+    if v is not None and magnitude(v) * len(v) < 1 << 63:
+        return int(v.sum())
+    return sum(data)
+
+def builtin_fill(a, value):
+    if type(a) is not ArrayValue: raise EvalError('array expected')
+    a.data = [value] * len(a.data)
+    try:
+        a.data = array('q', a.data[:1]) * len(a.data)
+    except (TypeError, OverflowError):
+        pass
+    return a
+
+def builtin_range(n):
+    if type(n) is not int or n < 0: raise EvalError('invalid range')
+    return ArrayValue(array('q', range(n)))
+
+def elementwise(op, a, b):
+    """Apply op (operator.add or operator.mul) to the elements of a and
+    b, an array of the same length as a or an integer."""
+    x = int_array(a)
+    y = b if type(b) is int else int_array(b)
+    if type(b) is not int and len(y) != len(x):
+        raise EvalError('arrays of different lengths')
+    u = as_numpy(x)
+    v = y if type(b) is int else as_numpy(y)
+    if u is not None and v is not None:
+        m, n = magnitude(u), abs(v) if type(b) is int else magnitude(v)
+        # NumPy integers wrap around silently: only use it when it is exact,
+        # and when the scalar b fits in an int64 itself (a may be all zeros)
+        if n < 1 << 63 and (m + n if op is operator.add else m * n) < 1 << 63:
+            try:
+                return from_numpy(op(u, v))
+            except OverflowError:
+                pass
+    if type(b) is int:
+        return make_array([op(p, b) for p in x])
+    return make_array(list(map(op, x, y)))
+
+def builtin_add(a, b):
+    return elementwise(operator.add, a, b)
+
+def builtin_mul(a, b):
+    return elementwise(operator.mul, a, b)
+
+def builtin_argmax(a):
+    data = int_array(a)
+    if not data: raise EvalError('argmax of an empty array')
+    v = as_numpy(data)
+    if v is not None: return int(v.argmax())
+    return max(range(len(data)), key=data.__getitem__)
+
+# name -> (number of arguments, implementation)
+builtins = {
+    'len': (1, builtin_len),
+    'sum': (1, builtin_sum),
+    'fill': (2, builtin_fill),
+    'range': (1, builtin_range),
+    'add': (2, builtin_add),
+    'mul': (2, builtin_mul),
+    'argmax': (1, builtin_argmax),
+}
+
+# builtins which change the arrays they are given
+mutating_builtins = frozenset(['fill'])
+
+def call_builtin(name, args):
+    """Return the result of the builtin name applied to the values args."""
+    try:
+        arity, builtin = builtins[name]
+    except KeyError:
+        raise EvalError('call to undefined procedure %s' % name)
+    if len(args) != arity:
+        raise EvalError('wrong number of arguments to %s' % name)
+    return builtin(*args)
+
+# Statements are compiled into lists of instructions, which are tuples
+# whose first item is one of these opcodes:
+#   (ASSIGN, name, exp)                 name = exp
+#   (STORE, indexable, index, exp)      indexable[index] = exp
+#   (JUMP_IF_FALSE, exp, target)        if exp is false, go to target
+#   (JUMP_IF_TRUE, exp, target)         if exp is true, go to target
+#   (COMPARE_JUMP, op, left, right, sense, target)
+#                                       if the truth of left op right is
+#                                       sense, go to target
+#   (JUMP, target)                      go to target
+#   (CALL, call) / (TAIL_CALL, call)    call the procedure of node call
+#   (PRINT, exp)
+#   (DEFINE, def)                       define the procedure of node def
+#   (FAIL, msg)                         raise an EvalError
+#   (HOIST, [(name, exp), ...])         name = exp for each pair, where exp
+#                                       is pure and name a temporary, which
+#                                       is unset if exp fails
+# Jumps are the instructions whose last item is their target.  Reaching
+# the end of the instructions returns from the procedure.
+
+(ASSIGN, STORE, JUMP_IF_FALSE, JUMP_IF_TRUE, COMPARE_JUMP, JUMP, CALL,
+ TAIL_CALL, PRINT, DEFINE, FAIL, HOIST) = range(12)
+
+# opcode -> positions of the expressions in its instructions
+operands = {ASSIGN: (2,), STORE: (1, 2, 3), JUMP_IF_FALSE: (1,),
+            JUMP_IF_TRUE: (1,), COMPARE_JUMP: (2, 3), PRINT: (1,)}
+
+versions = itertools.count()   # versions of the procedures of runtimes
+
+def compile_stmt(node, graph=None):
+    """Return the list of instructions of the statement node, optimized
+    with the call graph graph of the program when it is given."""
+    code = []
+    node.compile(code, True, graph)
+    return code
+
+def compile_proc(proc, graph=None):
+    """Return the list of instructions of the body of the Def node proc;
+    the variables it never assigns are read from the globals directly."""
+    code = compile_stmt(proc.body, graph)
+    if graph is not None:
+        names = graph.globals_read(proc.name)
+        if names: bind_globals(code, names)
+    return code
+
+def patch(code, jumps, target):
+    """Set the target of the jumps at positions jumps of code."""
+    for i in jumps:
+        code[i] = code[i][:-1] + (target,)
+
+temporaries = itertools.count()  # numbers of the temporaries of the compiler
+
+class Global(Node):
+    """Class of nodes reading the global variable name, from a procedure
+    which never assigns it."""
+    fields = ['name']
+    def evaluate(self, rt, env):
+        try: return rt.globals[self.name]
+        except KeyError: raise EvalError('undefined variable %s' % self.name)
+
+def bind_global_vars(node, names):
+    """Return the expression node with its variables in names replaced by
+    Global nodes."""
+    t = type(node)
+    if t is Var:
+        return Global(node.name) if node.name in names else node
+    if t is Index:
+        new = Index(bind_global_vars(node.indexable, names),
+                    bind_global_vars(node.index, names))
+    elif t is BinOpExp:
+        new = BinOpExp(bind_global_vars(node.left, names), node.op,
+                       bind_global_vars(node.right, names))
+    elif t is UniOpExp:
+        new = UniOpExp(node.op, bind_global_vars(node.arg, names))
+    elif t is Array:
+        new = Array([bind_global_vars(e, names) for e in node.elements])
+    elif t is Call:
+        new = Call(node.name, [bind_global_vars(a, names) for a in node.args])
+        new.line, new.column = node.line, node.column
+    elif t is Temp:
+        new = Temp(node.name, bind_global_vars(node.exp, names))
+    else:
+        return node
+    return new
+
+def bind_globals(code, names):
+    """Make the instructions code read the variables in names from the
+    globals (see Global)."""
+    for pc, ins in enumerate(code):
+        op = ins[0]
+        if op in operands:
+            ins = list(ins)
+            for i in operands[op]:
+                ins[i] = bind_global_vars(ins[i], names)
+            code[pc] = tuple(ins)
+        elif op == CALL or op == TAIL_CALL:
+            code[pc] = (op, bind_global_vars(ins[1], names))
+        elif op == HOIST:
+            code[pc] = (op, [(name, bind_global_vars(exp, names))
+                             for name, exp in ins[1]])
+
+class Temp(Node):
+    """Class of nodes reading a temporary variable of the compiler, or
+    evaluating exp when the temporary is not set."""
+    fields = ['name', 'exp']
+    def evaluate(self, rt, env):
+        try: return env[self.name]
+        except KeyError: return self.exp.evaluate(rt, env)
+
+def subexpressions(node, eager, found):
+    """Return a key identifying the value of node, or None if it may
+    differ each time; add (key, node, eager) to found for each compound
+    subexpression, eager if it is evaluated whenever node is."""
+    t = type(node)
+    if t is Var:
+        return ('v', node.name)
+    if t is Int or t is String:
+        return (t.__name__, node.value)
+    if t is Temp:
+        return ('t', node.name)
+    if t is Index:
+        key = ('[]', subexpressions(node.indexable, eager, found),
+               subexpressions(node.index, eager, found))
+    elif t is BinOpExp:
+        # the right operand of and, or is evaluated only on some paths
+        right_eager = eager and node.op not in ('and', 'or')
+        key = (node.op, subexpressions(node.left, eager, found),
+               subexpressions(node.right, right_eager, found))
+    elif t is UniOpExp:
+        key = (node.op, subexpressions(node.arg, eager, found))
+    else:
+        return None
+    if None in key:
+        return None
+    found.append((key, node, eager))
+    return key
+
+def substitute(node, keys, temps):
+    """Return the expression node with its subexpressions whose keys are
+    in temps replaced by the corresponding Temp nodes."""
+    key = keys.get(id(node))
+    if key in temps:
+        return temps[key]
+    t = type(node)
+    if t is Index:
+        return Index(substitute(node.indexable, keys, temps),
+                     substitute(node.index, keys, temps))
+    if t is BinOpExp:
+        return BinOpExp(substitute(node.left, keys, temps), node.op,
+                        substitute(node.right, keys, temps))
+    if t is UniOpExp:
+        return UniOpExp(node.op, substitute(node.arg, keys, temps))
+    return node
+
+def compile_condition(exp, code, sense, jumps):
+    """Append to code instructions which jump if the truth of exp is
+    sense, computing repeated subexpressions (s[k] in j==s[k]+1) once."""
+    found = []
+    if subexpressions(exp, True, found) is not None:
+        counts, eager = {}, set()
+        for key, node, evaluated in found:
+            counts[key] = counts.get(key, 0) + 1
+            if evaluated: eager.add(key)
+        keys = dict((id(node), key) for key, node, evaluated in found)
+        temps = {}
+        # found lists inner subexpressions first, so that a temporary may
+        # be computed from the previous ones
+        for key, node, evaluated in found:
+            if counts[key] > 1 and key in eager and key not in temps:
+                temp = Temp('%%%d' % next(temporaries), node)
+                code.append((ASSIGN, temp.name, substitute(node, keys, temps)))
+                temps[key] = temp
+        exp = substitute(exp, keys, temps)
+    exp.compile_jump(code, sense, jumps)
+
+def may_be_array(node):
+    """Tell if the value of the expression node may be an array."""
+    t = type(node)
+    if t is Int or t is String or t is UniOpExp:
+        return False
+    if t is BinOpExp:
+        # only + on two arrays gives an array
+        return (node.op == '+' and may_be_array(node.left)
+                and may_be_array(node.right))
+    return True
+
+# Variables the loop does not assign are invariant, and so are indexings if
+# the loop stores into no array and calls no procedure which may (as told
+# by graph).  Expressions which may build an array are not: each evaluation
+# gives a new one.  Hoisted expressions are pure; a failure to compute one
+# is deferred to the uses of its temporary.
+class LoopInvariants(object):
+    """Hoisting of the loop-invariant expressions of the instructions
+    code[start:end] of the body and condition of a loop."""
+
+    def __init__(self, code, start, end, graph=None):
+        self.code, self.start, self.end = code, start, end
+        self.graph = graph
+        self.assigned = set()
+        self.mutates = False
+        self.temps = {}         # key of expression -> Temp node
+        self.hoisted = []       # (name of temporary, expression)
+        for ins in code[start:end]:
+            op = ins[0]
+            if op == ASSIGN:
+                self.assigned.add(ins[1])
+            elif op == HOIST:
+                self.assigned.update(name for name, exp in ins[1])
+            elif op == STORE:
+                self.mutates = True
+            elif op == CALL or op == TAIL_CALL:
+                if not self.pure(ins[1]): self.mutates = True
+            if op in operands:
+                for i in operands[op]:
+                    # an expression may call a builtin which stores
+                    if not self.pure(ins[i]): self.mutates = True
+
+    def pure(self, node):
+        """Tell if the expression node stores into no array."""
+        t = type(node)
+        if t is Call:
+            return (self.graph is not None and self.graph.is_pure(node.name)
+                    and all(self.pure(a) for a in node.args))
+        if t is Index:
+            return self.pure(node.indexable) and self.pure(node.index)
+        if t is BinOpExp:
+            return self.pure(node.left) and self.pure(node.right)
+        if t is UniOpExp:
+            return self.pure(node.arg)
+        if t is Array:
+            return all(self.pure(e) for e in node.elements)
+        return True
+
+    def invariant(self, node):
+        """Tell if the value of the expression node is the same throughout
+        the loop."""
+        t = type(node)
+        if t is Var or t is Temp:
+            return node.name not in self.assigned
+        if t is Int or t is String:
+            return True
+        if t is Index:
+            return (not self.mutates and self.invariant(node.indexable)
+                    and self.invariant(node.index))
+        if t is BinOpExp:
+            if may_be_array(node.left) and may_be_array(node.right):
+                if self.mutates or may_be_array(node): return False
+            return self.invariant(node.left) and self.invariant(node.right)
+        if t is UniOpExp:
+            return self.invariant(node.arg)
+        return False
+
+    def rewrite(self, node):
+        """Return the expression node with its maximal invariant
+        subexpressions (but literals) replaced by temporaries."""
+        t = type(node)
+        if t is Int or t is String:
+            return node
+        if self.invariant(node):
+            key = subexpressions(node, True, [])
+            temp = self.temps.get(key)
+            if temp is None:
+                temp = Temp('%%%d' % next(temporaries), node)
+                self.temps[key] = temp
+                self.hoisted.append((temp.name, node))
+            return temp
+        if t is Index:
+            return Index(self.rewrite(node.indexable), self.rewrite(node.index))
+        if t is BinOpExp:
+            return BinOpExp(self.rewrite(node.left), node.op, self.rewrite(node.right))
+        if t is UniOpExp:
+            return UniOpExp(node.op, self.rewrite(node.arg))
+        if t is Array:
+            return Array([self.rewrite(e) for e in node.elements])
+        if t is Call:
+            return self.rewrite_call(node)
+        return node
+
+    def rewrite_call(self, call):
+        args = [self.rewrite(a) for a in call.args]
+        if all(a is b for a, b in zip(args, call.args)):
+            return call
+        new = Call(call.name, args)
+        new.line, new.column = call.line, call.column
+        return new
+
+    def hoist(self):
+        """Rewrite the instructions of the loop; return the list of pairs
+        (name of temporary, expression) to compute before the loop."""
+        code = self.code
+        for pc in range(self.start, self.end):
+            ins = code[pc]
+            op = ins[0]
+            if op in operands:
+                ins = list(ins)
+                for i in operands[op]:
+                    ins[i] = self.rewrite(ins[i])
+                code[pc] = tuple(ins)
+            elif op == CALL or op == TAIL_CALL:
+                code[pc] = (op, self.rewrite_call(ins[1]))
+            elif op == HOIST:
+                code[pc] = (op, [(name, self.rewrite(exp)) for name, exp in ins[1]])
+        return self.hoisted
+
+class Frame(object):
+    """Activation record of a suspended procedure call."""
+    __slots__ = ['code', 'pc', 'env']
+
+CHECK_INTERVAL = 1024   # steps between two checks of the limits of a run
+
+# Calls run on an explicit stack of recycled frames, tail calls reusing the
+# caller's; call sites cache their procedure until a definition changes the
+# version of the procedures.  Steps (backward jumps and calls) and time are
+# checked against the limits every CHECK_INTERVAL steps at most.
+class Runtime(object):
+    """State of a running program: its global variables, its procedures
+    and the output channel of its print statements."""
+
+    def __init__(self, out=None, max_depth=1000000, max_steps=None,
+                 timeout=None, pause=None, graph=None):
+        self.out = out if out is not None else Output()
+        self.graph = graph
+        self.globals = {}
+        self.procs = {}
+        self.version = next(versions)
+        self.max_depth = max_depth
+        self.steps_left = max_steps
+        self.deadline = None if timeout is None else time.monotonic() + timeout
+        self.pause = pause
+
+    def next_slice(self):
+        """Check the limits of the run; return the number of steps allowed
+        before the next check."""
+        if self.pause is not None:
+            self.pause()
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            raise EvalError('time limit exceeded')
+        steps = CHECK_INTERVAL
+        if self.steps_left is not None:
+            if self.steps_left <= 0:
+                raise EvalError('step limit exceeded')
+            steps = min(steps, self.steps_left)
+            self.steps_left -= steps
+        return steps
+
+    def define(self, proc):
+        """Define (or redefine) the procedure of the Def node proc."""
+        self.procs[proc.name] = proc
+        self.version = next(versions)
+
+    def resolve(self, call):
+        """Fill the inline cache of the Call node call."""
+        proc = self.procs.get(call.name)
+        if proc is not None:
+            if len(proc.params) != len(call.args):
+                raise EvalError('wrong number of arguments to %s' % call.name)
+            if proc.code is None:
+                proc.code = compile_proc(proc, self.graph)
+        call.target, call.version = proc, self.version
+
+    def execute(self, code, env):
+        """Run the instructions code with the local variables env."""
+        stack, pool = [], []
+        pc, end = 0, len(code)
+        ticks = 0       # steps left before next_slice checks the limits
+        while True:
+            if pc >= end:
+                # return from the current procedure
+                if not stack: return
+                frame = stack.pop()
+                code, pc, env = frame.code, frame.pc, frame.env
+                end = len(code)
+                pool.append(frame)
+                continue
+            ins = code[pc]
+            op = ins[0]
+            pc += 1
+            if op == ASSIGN:
+                env[ins[1]] = ins[2].evaluate(self, env)
+            elif op == COMPARE_JUMP:
+                a = ins[2].evaluate(self, env)
+                b = ins[3].evaluate(self, env)
+                cmp = ins[1]
+                if type(a) is int and type(b) is int:
+                    result = a == b if cmp == '==' else a < b if cmp == '<' else a > b
+                else:
+                    result = binop_value(cmp, a, b)
+                if bool(result) is ins[4]:
+                    if ins[5] < pc:
+                        if ticks: ticks -= 1
+                        else: ticks = self.next_slice() - 1
+                    pc = ins[5]
+            elif op == JUMP_IF_FALSE:
+                if not truth(ins[1].evaluate(self, env)):
+                    if ins[2] < pc:
+                        if ticks: ticks -= 1
+                        else: ticks = self.next_slice() - 1
+                    pc = ins[2]
+            elif op == JUMP_IF_TRUE:
+                if truth(ins[1].evaluate(self, env)):
+                    if ins[2] < pc:
+                        if ticks: ticks -= 1
+                        else: ticks = self.next_slice() - 1
+                    pc = ins[2]
+            elif op == JUMP:
+                if ins[1] < pc:
+                    if ticks: ticks -= 1
+                    else: ticks = self.next_slice() - 1
+                pc = ins[1]
+            elif op == STORE:
+                value = ins[3].evaluate(self, env)
+                store_index(ins[1].evaluate(self, env), ins[2].evaluate(self, env), value)
+            elif op == CALL or op == TAIL_CALL:
+                if ticks: ticks -= 1
+                else: ticks = self.next_slice() - 1
+                call = ins[1]
+                if call.version != self.version:
+                    self.resolve(call)
+                proc = call.target
+                if proc is None:
+                    call_builtin(call.name, [a.evaluate(self, env) for a in call.args])
+                    continue
+                args = [a.evaluate(self, env) for a in call.args]
+                if op == CALL:
+                    if len(stack) >= self.max_depth:
+                        raise EvalError('too many nested calls')
+                    frame = pool.pop() if pool else Frame()
+                    frame.code, frame.pc, frame.env = code, pc, env
+                    stack.append(frame)
+                code, pc, env = proc.code, 0, dict(zip(proc.params, args))
+                end = len(code)
+            elif op == PRINT:
+                self.out.write_value(ins[1].evaluate(self, env))
+            elif op == DEFINE:
+                self.define(ins[1])
+            elif op == HOIST:
+                for name, exp in ins[1]:
+                    try: env[name] = exp.evaluate(self, env)
+                    except EvalError: env.pop(name, None)
+            else:
+                raise EvalError(ins[1])
+
+def run(node, out=None, max_steps=None, timeout=None, pause=None):
+    """Execute the program node, printing to out, within the limits
+    max_steps and timeout (see Runtime); return the runtime."""
+    rt = Runtime(out, max_steps=max_steps, timeout=timeout, pause=pause,
+                 graph=call_graph(node))
+    try:
+        code = []
+        node.compile(code, False, rt.graph)
+        rt.execute(code, rt.globals)
+    finally:
+        rt.out.flush()
+    return rt
+
+# Below is the driver code, which parses a given MustScript program
+# and analyzes the definitions and uses of procedures and variables
+
+def analyze(node):
+    """Run the analyzers on the program node; their findings are recorded
+    in diagnostics.  The analyzers share their sets through globals."""
+    global proc_defined, proc_called, global_var_env
+    global procs_defined, procs_called
 
     # set up and call method for analyzing procedures (imperative)
     proc_defined, proc_called = set(), set()
     anlz_procs_imp(node)
-    if {p for p in proc_called if p not in proc_defined}:
+    if {p for p in proc_called if p not in proc_defined and p not in builtins}:
     	#A call to procedure p but not defined, thus dictionary {} not empty returns true
         try:
             raise AnalError('containing call to undefined procedure')
         except AnalError:
-             print('Error8')
+             diagnostics.emit(ERROR, None, 'Error8')
     if {p for p in proc_defined if p not in proc_called}: # bonus dead code
         try:
             raise AnalError('containing definition of not-called procedure')
         except AnalError:
-    	    print('Error9')
+    	    diagnostics.emit(ERROR, None, 'Error9')
 
     # set up and call method for analyzing variables (imperative)
     global_var_env, local_var_env, is_global = set(), set(), True
@@ -442,11 +1945,11 @@ try:
     #pdb.set_trace()
     procs_defined,procs_called = set(),set()
     procs_defined,procs_called = anlz_procs_fun(node,procs_defined,procs_called)
-    if {p for p in procs_called if p not in procs_defined}:
+    if {p for p in procs_called if p not in procs_defined and p not in builtins}:
     	try:
     		raise AnalError('Call to undefined procedure')
     	except AnalError:
-    		print('Errorrr')
+    		diagnostics.emit(ERROR, None, 'Errorrr')
     
     global_var_env, local_var_env, is_global = set(),set(),True
     global_var_env,local_var_env = anlz_vars_fun(node,global_var_env,local_var_env,is_global)
@@ -460,26 +1963,69 @@ try:
     procs_defined,procs_called = set(),set()
     node.anlz_procs()
     node.anlz_procs_called()
-    if {p for p in proc_called if p not in proc_defined}:
-        print('call to undefined proc')
+    if {p for p in proc_called if p not in proc_defined and p not in builtins}:
+        diagnostics.emit(ERROR, None, 'call to undefined proc')
     global_var_env, local_var_env, is_global = set(),set(),True
     node.anlz_vars(local_var_env,True)
     # set up and call method for analyzing variables (object-oriented):
     # your methods could be named anlz_procs_obj and anlz_vars_obj
 
-# If an exception is rasied, print the appropriate error.
-except tpg.Error:
-    print('Parsing Error')
+def main(argv):
+    # Open the input file, and read in the input program.  With the option -q
+    # after the file name, the analysis only reports errors.
+    prog = open(argv[1]).read()
+    if '-q' in argv[2:]: diagnostics.verbosity = ERROR
+
+    try:
+        # Try to parse the program.
+        print('Parsing...')
+        # MUSTSCRIPT_CACHE names a directory where parsed programs are cached,
+        # MUSTSCRIPT_JOBS a number of processes parsing big programs, and
+        # MUSTSCRIPT_LAZY, when set, has only the bodies of the procedures
+        # that may run parsed
+        jobs = int(os.environ.get('MUSTSCRIPT_JOBS') or 1)
+        lazy = bool(os.environ.get('MUSTSCRIPT_LAZY'))
+        if lazy: parser = LazyParser()
+        elif jobs > 1: parser = ParallelParser(jobs)
+        else: parser = None
+        node = parse(prog, os.environ.get('MUSTSCRIPT_CACHE'), parser=parser)
+        # the call graph parses the bodies of the live procedures, so that
+        # their syntax errors are reported before the analysis, which skips
+        # the bodies left unparsed
+        if lazy: call_graph(node)
+
+        # Try to analyze the program.
+        print('Analyzing...')
+        analyze(node)
+
+        # write out all the findings of the analysis at once
+        diagnostics.flush()
+
+        # drop procedures that are never called before going any further
+        node = eliminate_dead_procs(node)
+
+        # Run the program.  Its output is buffered and written out in batches.
+        run(node, Output(sys.stdout))
+
+    # If an exception is rasied, print the appropriate error.
+    except tpg.Error:
+        print('Parsing Error')
+
+        # Uncomment the next line to re-raise the parsing error,
+        # displaying where the error occurs.  Comment it for submission.
+
+        # raise
 
-    # Uncomment the next line to re-raise the parsing error,
-    # displaying where the error occurs.  Comment it for submission.
+    except EvalError:
+        print('Evaluation Error')
 
-    # raise
+    except AnalError as e:
+        print('Analysis Error')
 
-except AnalError as e:
-    print('Analysis Error')
+        # Uncomment the next line to re-raise the evaluation error, 
+        # displaying where the error occurs.  Comment it for submission.
 
-    # Uncomment the next line to re-raise the evaluation error, 
-    # displaying where the error occurs.  Comment it for submission.
+        raise
 
-    raise
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,234 @@
+"""Service running MustScript programs.
+
+The server listens on a local (Unix domain) socket, or talks over its stdin
+and stdout, and exchanges frames: a kind byte, the length of the payload as
+4 bytes big endian, and the payload.  A client sends a SCRIPT frame with the
+source of a program; the server answers with a DIAGNOSTICS frame holding
+the findings of the analysis, OUTPUT frames with what the program prints,
+sent while it runs, and a DONE frame, whose payload is empty on success or
+else the error ('Parsing Error', 'Evaluation Error', ...).  A connection
+may submit any number of scripts, one after the other.
+
+Programs are parsed, analyzed and run in a pool of worker processes, each
+reusing one Parser; a worker sends the output of a program through a pipe,
+which the event loop reads when it is readable.  A running program hands
+over its output at the periodic checks of its runtime, every few loop
+iterations or calls.  Programs run for DEFAULT_TIMEOUT seconds at most,
+unless another limit is given (0 for none).
+
+    python a5server.py serve SOCKET [-q] [--steps N] [--timeout SECONDS]
+    python a5server.py stdio [-q] [--steps N] [--timeout SECONDS]
+    python a5server.py client SOCKET FILE
+"""
+
+import argparse
+import asyncio
+import concurrent.futures
+import io
+import multiprocessing
+import struct
+import sys
+import tpg
+
+import a5main
+
+# kinds of frames
+SCRIPT, DIAGNOSTICS, OUTPUT, DONE = b'S', b'D', b'O', b'Z'
+
+DEFAULT_TIMEOUT = 60.0  # seconds a program may run by default
+
+header = struct.Struct('>cI')
+
+def frame(kind, payload):
+    """Return the bytes of a frame."""
+    return header.pack(kind, len(payload)) + payload
+
+async def read_frame(reader):
+    """Read a frame from the stream reader; return (kind, payload)."""
+    kind, size = header.unpack(await reader.readexactly(header.size))
+    return kind, await reader.readexactly(size)
+
+# Worker processes.
+
+parser = None   # parser of the worker process, reused by its scripts
+
+def start_worker():
+    global parser
+    parser = a5main.Parser()
+
+class PipeSink(object):
+    """Sink of an Output, sending what is written as OUTPUT messages."""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def write(self, text):
+        self.conn.send((OUTPUT, text))
+
+def run_script(source, conn, verbosity, max_steps, timeout):
+    """Parse, analyze and run the program source in a worker process,
+    sending messages (kind, text) to the connection conn and None at the
+    end; return the error, or '' on success."""
+    a5main.diagnostics = a5main.Diagnostics(verbosity)
+    try:
+        node = a5main.parse(source, parser=parser)
+        a5main.analyze(node)
+        text = io.StringIO()
+        a5main.diagnostics.flush(text)
+        conn.send((DIAGNOSTICS, text.getvalue()))
+        node = a5main.eliminate_dead_procs(node)
+        out = a5main.Output(PipeSink(conn))
+        a5main.run(node, out, max_steps, timeout or None, pause=out.flush)
+    except tpg.Error:
+        return 'Parsing Error'
+    except a5main.EvalError:
+        return 'Evaluation Error'
+    except a5main.AnalError:
+        return 'Analysis Error'
+    finally:
+        conn.send(None)
+        conn.close()
+    return ''
+
+# Server.
+
+class Server(object):
+    """Server of MustScript programs, running at most workers programs at
+    once (the number of processors by default) within the limits
+    max_steps and timeout of a5main.Runtime."""
+
+    def __init__(self, workers=None, verbosity=a5main.INFO, max_steps=None,
+                 timeout=DEFAULT_TIMEOUT):
+        self.verbosity = verbosity
+        self.max_steps = max_steps
+        self.timeout = timeout
+        self.processes = concurrent.futures.ProcessPoolExecutor(
+            workers, initializer=start_worker)
+
+    def close(self):
+        self.processes.shutdown()
+
+    async def handle(self, reader, writer):
+        """Serve the scripts sent over a connection."""
+        try:
+            while True:
+                try:
+                    kind, payload = await read_frame(reader)
+                except asyncio.IncompleteReadError:
+                    break
+                if kind != SCRIPT:
+                    writer.write(frame(DONE, b'Protocol Error'))
+                    break
+                await self.serve(payload.decode('utf-8'), writer)
+        except ConnectionError:
+            pass    # the client went away
+        finally:
+            writer.close()
+
+    async def serve(self, source, writer):
+        """Run the program source, streaming its results to writer."""
+        loop = asyncio.get_running_loop()
+        receiver, sender = multiprocessing.Pipe(duplex=False)
+        messages = asyncio.Queue()
+        def receive():
+            try:
+                while receiver.poll():
+                    messages.put_nowait(receiver.recv())
+            except EOFError:
+                loop.remove_reader(receiver.fileno())
+        loop.add_reader(receiver.fileno(), receive)
+        try:
+            result = asyncio.ensure_future(self.finish(loop.run_in_executor(
+                self.processes, run_script, source, sender, self.verbosity,
+                self.max_steps, self.timeout), messages))
+            while True:
+                message = await messages.get()
+                if message is None:
+                    break
+                kind, text = message
+                writer.write(frame(kind, text.encode('utf-8')))
+                await writer.drain()
+            error = await result
+        finally:
+            loop.remove_reader(receiver.fileno())
+            receiver.close()
+            sender.close()
+        writer.write(frame(DONE, error.encode('utf-8')))
+        await writer.drain()
+
+    async def finish(self, result, messages):
+        """Return the error of the run whose result is the future result;
+        if the worker failed, end the messages in its stead."""
+        try:
+            return await result
+        except Exception:
+            messages.put_nowait(None)
+            return 'Internal Error'
+
+    async def serve_socket(self, path):
+        """Serve the clients connecting to the Unix socket path."""
+        server = await asyncio.start_unix_server(self.handle, path)
+        async with server:
+            await server.serve_forever()
+
+    async def serve_stdio(self):
+        """Serve the scripts sent over stdin, answering on stdout."""
+        loop = asyncio.get_running_loop()
+        reader = asyncio.StreamReader()
+        await loop.connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(reader), sys.stdin.buffer)
+        transport, protocol = await loop.connect_write_pipe(
+            asyncio.streams.FlowControlMixin, sys.stdout.buffer)
+        writer = asyncio.StreamWriter(transport, protocol, reader, loop)
+        await self.handle(reader, writer)
+
+# Stand-in client.
+
+async def submit(path, source, out=None):
+    """Run the program source on the server at the Unix socket path,
+    writing its results to out (stdout by default) as they arrive;
+    return the error, or '' on success."""
+    out = out or sys.stdout
+    reader, writer = await asyncio.open_unix_connection(path)
+    try:
+        writer.write(frame(SCRIPT, source.encode('utf-8')))
+        await writer.drain()
+        while True:
+            kind, payload = await read_frame(reader)
+            text = payload.decode('utf-8')
+            if kind == DONE:
+                if text: out.write(text + '\n')
+                return text
+            out.write(text)
+            out.flush()
+    finally:
+        writer.close()
+
+def main(argv):
+    options = argparse.ArgumentParser(description='Serve MustScript programs.')
+    options.add_argument('mode', choices=['serve', 'stdio', 'client'])
+    options.add_argument('path', nargs='?', help='Unix socket of the server')
+    options.add_argument('file', nargs='?', help='program sent by the client')
+    options.add_argument('-q', action='store_true', help='report only errors')
+    options.add_argument('--steps', type=int, help='step limit of a program')
+    options.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT,
+                         help='time limit of a program in seconds, 0 for none'
+                              ' (default %(default)s)')
+    options.add_argument('--workers', type=int, help='number of worker processes')
+    args = options.parse_args(argv[1:])
+    if args.mode == 'client':
+        source = open(args.file).read()
+        asyncio.run(submit(args.path, source))
+        return
+    server = Server(args.workers, a5main.ERROR if args.q else a5main.INFO,
+                    args.steps, args.timeout)
+    try:
+        if args.mode == 'serve':
+            asyncio.run(server.serve_socket(args.path))
+        else:
+            asyncio.run(server.serve_stdio())
+    finally:
+        server.close()
+
+if __name__ == '__main__':
+    main(sys.argv)
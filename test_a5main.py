@@ -0,0 +1,434 @@
+"""Regression tests of the MustScript interpreter.
+
+Run with: python -m unittest test_a5main
+"""
+
+import contextlib
+import io
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import a5main
+import tpg
+
+
+def output(source):
+    """Parse and run the program source; return what it prints."""
+    out = io.StringIO()
+    a5main.run(a5main.parse(source), a5main.Output(out))
+    return out.getvalue()
+
+
+class LoopInvariantsTest(unittest.TestCase):
+
+    def test_operation_on_stored_array(self):
+        # a + b reads the elements of a, which the loop stores into
+        self.assertEqual(output(
+            '{ a = [1, 2]; b = [0]; i = 0;'
+            '  while (i < 3) { a[0] = i; print a + b; i = i + 1; } }'),
+            '[0, 2, 0]\n[1, 2, 0]\n[2, 2, 0]\n')
+
+    def test_new_array_each_iteration(self):
+        # a + b must build a new array at each iteration
+        self.assertEqual(output(
+            '{ a = [1]; b = [2, 3]; r = [0, 0, 0]; i = 0;'
+            '  while (i < 3) { r[i] = a + b; i = i + 1; }'
+            '  r[0][0] = 99; print r; }'),
+            '[[99, 2, 3], [1, 2, 3], [1, 2, 3]]\n')
+        self.assertEqual(output(
+            '{ a = [1]; b = [2, 3]; k = 0;'
+            '  while (k < 2) { x = a + b; x[0] = 5; print a + b; k = k + 1; } }'),
+            '[1, 2, 3]\n[1, 2, 3]\n')
+
+    def test_scalar_invariant(self):
+        self.assertEqual(output(
+            '{ n = 4; m = 0; t = 0;'
+            '  while (m < 3) { t = t + n * 2; m = m + 1; } print t; }'),
+            '24\n')
+
+
+class CallGraphTest(unittest.TestCase):
+
+    source = '''{
+      def even(n) { if (n > 0) odd(n - 1); }
+      def odd(n) { if (n > 0) even(n - 1); }
+      def get(a, i) { print a[i] + k; }
+      def set(a) { a[0] = 1; }
+      def clear(a) { fill(a, 0); }
+      def outer() { def inner() { print 1; } inner(); }
+      def self(n) { if (n > 0) self(n - 1); }
+      def dead() { set(x); }
+      k = 1; even(4); get([1], 0); set([0]); clear([0]); outer(); self(1);
+    }'''
+
+    def test_queries(self):
+        graph = a5main.call_graph(a5main.parse(self.source))
+        self.assertEqual(graph.callees['even'], {'odd'})
+        self.assertEqual(graph.callers['odd'], {'even'})
+        self.assertEqual(graph.callers['even'], {None, 'odd'})
+        self.assertEqual(graph.definition('get').params, ['a', 'i'])
+        self.assertIsNone(graph.definition('len'))
+        self.assertTrue(graph.is_recursive('even'))
+        self.assertTrue(graph.is_recursive('self'))
+        self.assertFalse(graph.is_recursive('get'))
+        self.assertIn(frozenset(['even', 'odd']), graph.sccs)
+        self.assertEqual(graph.globals_read('get'), {'k'})
+        self.assertEqual(graph.globals_read('set'), set())
+        for proc in ['even', 'get', 'inner', 'self', 'len']:
+            self.assertTrue(graph.is_pure(proc), proc)
+        for proc in ['set', 'clear', 'outer', 'fill', 'undefined']:
+            self.assertFalse(graph.is_pure(proc), proc)
+
+    def test_prune(self):
+        node = a5main.parse(self.source)
+        graph = a5main.call_graph(node)
+        self.assertNotIn('dead', graph.live)
+        self.assertIn('dead', graph.defs)
+        a5main.eliminate_dead_procs(node)
+        self.assertIs(a5main.call_graph(node), graph)
+        self.assertNotIn('dead', graph.defs)
+        self.assertNotIn('dead', graph.callees)
+        self.assertEqual(graph.callers['set'], {None})
+
+    def test_calls_to_pure_procedures_keep_invariants(self):
+        source = ('{ def show(x) { y = x; } a = [5, 7]; i = 0;'
+                  '  while (i < 2) { show(i); print a[1]; i = i + 1; } }')
+        node = a5main.parse(source)
+        code = []
+        node.compile(code, False, a5main.call_graph(node))
+        hoists = [ins[1] for ins in code if ins[0] == a5main.HOIST]
+        self.assertEqual(len(hoists[0]), 1)
+        self.assertEqual(output(source), '7\n7\n')
+        # set stores into a: a[0] must be read again after each call
+        self.assertEqual(output(
+            '{ def set(a, v) { a[0] = v; } a = [0]; i = 0;'
+            '  while (i < 3) { set(a, i); print a[0]; i = i + 1; } }'),
+            '0\n1\n2\n')
+        self.assertEqual(output(
+            '{ def clear(a) { fill(a, 9); } a = [0]; i = 0;'
+            '  while (i < 2) { print a[0]; clear(a); i = i + 1; } }'),
+            '0\n9\n')
+
+    def test_globals_read_by_procedures(self):
+        self.assertEqual(output(
+            '{ def f() { print g; } g = 1; f(); g = 2; f(); }'), '1\n2\n')
+        # g is assigned in h, so it is read from the locals first
+        self.assertEqual(output(
+            '{ def h() { print g; g = 5; print g; } g = 1; h(); print g; }'),
+            '1\n5\n1\n')
+        with self.assertRaises(a5main.EvalError):
+            output('{ def f() { print g; } f(); }')
+
+
+class ParserTest(unittest.TestCase):
+
+    def test_expression_statement_must_be_call(self):
+        # the error is reported at the ';' ending the expression
+        with self.assertRaises(tpg.SyntacticError) as error:
+            a5main.parse('{ x; print 1; }')
+        self.assertEqual((error.exception.line, error.exception.column), (1, 4))
+        self.assertEqual(error.exception.msg, 'Syntax error near ;')
+
+    def test_assignment_to_non_lvalue(self):
+        for source, column in [('{ f(1) = 2; }', 8), ('{ f(1)[0] = 2; }', 11),
+                               ('{ 3 = 2; }', 5)]:
+            with self.assertRaises(tpg.SyntacticError) as error:
+                a5main.parse(source)
+            self.assertEqual(error.exception.column, column)
+            self.assertEqual(error.exception.msg, 'Syntax error near =')
+        node = a5main.parse('{ a[0][1] = 2; }')
+        self.assertIsInstance(node.stmts[0].left.indexable, a5main.Index)
+
+
+class LazyParserTest(unittest.TestCase):
+
+    def test_dead_bodies_are_not_parsed(self):
+        node = a5main.parse('{ def dead(x) { print x +; } def f(x) { print x; }'
+                            '  f(1); }', parser=a5main.LazyParser())
+        self.assertEqual(a5main.call_graph(node).live, {'f'})
+        a5main.analyze(node)
+        out = io.StringIO()
+        a5main.run(a5main.eliminate_dead_procs(node), a5main.Output(out))
+        self.assertEqual(out.getvalue(), '1\n')
+
+    def test_live_bodies_are_parsed_by_the_call_graph(self):
+        node = a5main.parse('{ def f(x) { print x +; } print 1; f(2); }',
+                            parser=a5main.LazyParser())
+        with self.assertRaises(tpg.SyntacticError):
+            a5main.call_graph(node)
+
+
+def tree(node):
+    """Return the AST node as nested tuples, with the positions of nodes."""
+    if isinstance(node, list):
+        return [tree(e) for e in node]
+    if not isinstance(node, a5main.Node):
+        return node
+    return ((type(node).__name__, node.line, node.column) +
+            tuple(tree(getattr(node, f)) for f in node.fields))
+
+
+class SerializationTest(unittest.TestCase):
+
+    sources = [open(os.path.join(os.path.dirname(__file__), name)).read()
+               for name in ['a5input1.txt', 'a5input2.txt', 'a5input4.txt']]
+    sources.append('{ a = [0 - 7, 300, "hé", ""]; def f(x, y) { print x; }'
+                   ' while (a[1] > 0) { a[1] = a[1] - 1; } if (not 1) f(1, 2); }')
+
+    def test_round_trip(self):
+        for source in self.sources:
+            node = a5main.parse(source)
+            data = a5main.dump_ast(node)
+            self.assertEqual(tree(a5main.load_ast(data)), tree(node))
+            lazy = a5main.load_ast(data, lazy=True)
+            self.assertIn('serialized', lazy.__dict__)
+            self.assertEqual(tree(lazy), tree(node))
+            with tempfile.TemporaryDirectory() as directory:
+                path = os.path.join(directory, 'ast.msa')
+                with open(path, 'wb') as f:
+                    f.write(data)
+                self.assertEqual(tree(a5main.open_ast(path)), tree(node))
+
+    def test_deep_tree(self):
+        node = a5main.Var('a')
+        for i in range(20000):
+            node = a5main.Index(node, a5main.Int(i))
+        node = a5main.load_ast(a5main.dump_ast(node), lazy=True)
+        for i in reversed(range(20000)):
+            self.assertEqual(node.index.value, i)
+            node = node.indexable
+        self.assertEqual(node.name, 'a')
+
+    def test_bad_data(self):
+        data = a5main.dump_ast(a5main.parse(self.sources[0]))
+        for bad in [b'', b'MSA\0' + data[4:], data + b'\0']:
+            with self.assertRaises((ValueError, IndexError)):
+                a5main.load_ast(bad)
+
+
+class ASTCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def entries(self):
+        return sorted(os.listdir(self.directory))
+
+    def test_hit(self):
+        cache = a5main.ASTCache(self.directory, 1 << 20)
+        source = SerializationTest.sources[1]
+        node = cache.parse(source)
+        with mock.patch.object(a5main.Parser, '__call__') as parser:
+            hit = cache.parse(source)
+        parser.assert_not_called()
+        self.assertIn('serialized', hit.__dict__)
+        self.assertEqual(tree(hit), tree(node))
+
+    def test_stale_entries(self):
+        cache = a5main.ASTCache(self.directory, 1 << 20)
+        cache.parse('{ print 1; }')
+        path, = self.entries()
+        path = os.path.join(self.directory, path)
+        # a changed program is another entry
+        self.assertEqual(tree(cache.parse('{ print 2; }').stmts[0].exp),
+                         ('Int', None, None, 2))
+        self.assertEqual(len(self.entries()), 2)
+        # an entry of another format, or a damaged one, is parsed again
+        with open(path, 'rb') as f:
+            data = f.read()
+        for data in [b'MSA\0', data[:-2]]:
+            with open(path, 'wb') as f:
+                f.write(data)
+            self.assertEqual(tree(cache.parse('{ print 1; }').stmts[0].exp),
+                             ('Int', None, None, 1))
+            self.assertEqual(tree(a5main.open_ast(path).stmts[0].exp),
+                             ('Int', None, None, 1))
+        # hits refresh the mtime of their entry
+        os.utime(path, (1, 1))
+        cache.parse('{ print 1; }')
+        self.assertGreater(os.stat(path).st_mtime, 1)
+
+    def test_eviction(self):
+        size = len(a5main.dump_ast(a5main.parse('{ print 10; }')))
+        cache = a5main.ASTCache(self.directory, 3 * size)
+        for i in range(10, 20):
+            cache.parse('{ print %d; }' % i)
+            paths = [os.path.join(self.directory, e) for e in self.entries()]
+            self.assertLessEqual(sum(os.stat(p).st_size for p in paths), 3 * size)
+            # order the entries as if time went by
+            for p in paths:
+                st = os.stat(p)
+                os.utime(p, (st.st_atime, st.st_mtime - 10))
+        self.assertEqual(len(self.entries()), 3)
+        # the least recently used entries went first
+        for i in [17, 18, 19]:
+            with mock.patch.object(a5main.Parser, '__call__') as parser:
+                cache.parse('{ print %d; }' % i)
+            parser.assert_not_called()
+
+
+class ParallelParserTest(unittest.TestCase):
+
+    def parse(self, parser, source):
+        """Return the tree parsed by parser from source, or its error."""
+        try:
+            return tree(parser(source))
+        except tpg.Error as error:
+            return type(error).__name__, error.line, error.column
+
+    def test_same_as_serial(self):
+        statement = ('  a = [1, "{;}"]; # } ; {\n'
+                     '  def f(x) {\n    if (x > 0) { print x; f(x - 1); }\n  }\n'
+                     '\tf(a[0]); print "x" + "y";\n')
+        parser = a5main.ParallelParser(jobs=2, min_size=0)
+        # programs which split, with or without errors in the runs
+        for source in ['\n # head\n  {' + statement * 20 + '}\n',
+                       '{' + statement * 20 + '}',
+                       '{' + statement * 10 + ' print 1 +; ' + statement * 10 + '}',
+                       '{' + statement * 10 + ' print 1 $ ' + statement * 10 + '}']:
+            self.assertIsNotNone(parser.split(source))
+            self.assertEqual(self.parse(parser, source),
+                             self.parse(a5main.Parser(), source))
+        # programs which do not
+        for source in ['{' + statement * 20 + '} print 1;',
+                       '{' + statement * 20]:
+            self.assertIsNone(parser.split(source))
+            self.assertEqual(self.parse(parser, source),
+                             self.parse(a5main.Parser(), source))
+
+
+class BuiltinsTest(unittest.TestCase):
+
+    programs = [
+        '{ a = range(100); print sum(add(a, 5)); print sum(mul(a, 0 - 3)); }',
+        '{ a = range(100); b = mul(a, a); print b[99]; print argmax(b); }',
+        '{ a = range(100); print sum(mul(a, 4611686018427387904)); }',
+        '{ a = fill(range(100), 0); b = mul(a, 1180591620717411303424);'
+        '  c = add(a, 1180591620717411303424); print b[3]; print c[3]; }',
+    ]
+
+    def test_without_numpy(self):
+        with mock.patch.object(a5main, 'numpy', None):
+            self.assertEqual(output(self.programs[0]), '5450\n-14850\n')
+            self.assertEqual(output(self.programs[1]), '9801\n99\n')
+
+    @unittest.skipIf(a5main.numpy is None, 'NumPy is not installed')
+    def test_numpy_matches_python(self):
+        for source in self.programs:
+            with mock.patch.object(a5main, 'numpy', None):
+                expected = output(source)
+            self.assertEqual(output(source), expected)
+
+    @unittest.skipIf(a5main.numpy is None, 'NumPy is not installed')
+    def test_numpy_only_when_exact(self):
+        with mock.patch.object(a5main, 'from_numpy',
+                               wraps=a5main.from_numpy) as from_numpy:
+            output(self.programs[0])
+            self.assertTrue(from_numpy.called)
+            from_numpy.reset_mock()
+            # the scalar does not fit in an int64, though a is all zeros
+            self.assertEqual(output(self.programs[3]),
+                             '0\n1180591620717411303424\n')
+            self.assertFalse(from_numpy.called)
+
+    def test_errors(self):
+        for source in ['{ print add(range(3), range(4)); }',
+                       '{ print sum(1); }', '{ print argmax([]); }']:
+            with self.assertRaises(a5main.EvalError):
+                output(source)
+
+
+def execute(source, **limits):
+    """Run the program source in a Runtime made with limits; return what it
+    prints."""
+    node = a5main.parse(source)
+    out = io.StringIO()
+    rt = a5main.Runtime(a5main.Output(out), graph=a5main.call_graph(node),
+                        **limits)
+    code = []
+    node.compile(code, False, rt.graph)
+    rt.execute(code, rt.globals)
+    rt.out.flush()
+    return out.getvalue()
+
+
+class RuntimeTest(unittest.TestCase):
+
+    loop = '{ i = 0; while (i < %d) i = i + 1; print i; }'
+    recursion = '{ def f(n) { if (n > 0) f(n - 1); } f(%d); print 0; }'
+
+    def test_step_limit(self):
+        # an iteration or a call is a step, across several checks
+        for source, steps in [(self.loop % 3000, 3000),
+                              (self.recursion % 3000, 3001),
+                              (self.loop % 1024, 1024)]:
+            self.assertTrue(execute(source, max_steps=steps))
+            with self.assertRaises(a5main.EvalError) as error:
+                execute(source, max_steps=steps - 1)
+            self.assertEqual(str(error.exception), 'step limit exceeded')
+        self.assertEqual(execute(self.loop % 0, max_steps=0), '0\n')
+
+    def test_time_limit(self):
+        with self.assertRaises(a5main.EvalError) as error:
+            execute('{ while (1) { } }', timeout=0.05)
+        self.assertEqual(str(error.exception), 'time limit exceeded')
+        pause = mock.Mock()
+        execute(self.loop % 3000, timeout=60, pause=pause)
+        self.assertEqual(pause.call_count, 3)
+
+    def test_tail_calls(self):
+        # calls in tail position do not nest
+        self.assertEqual(execute(self.recursion % 100000, max_depth=1), '0\n')
+
+    def test_deep_recursion(self):
+        source = ('{ def down(n) { if (n > 0) { down(n - 1); if (n == %d) print n; } }'
+                  '  down(%d); }')
+        self.assertEqual(output(source % (100000, 100000)), '100000\n')
+        # down(9) nests 10 calls
+        self.assertEqual(execute(source % (9, 9), max_depth=10), '9\n')
+        with self.assertRaises(a5main.EvalError) as error:
+            execute(source % (10, 10), max_depth=10)
+        self.assertEqual(str(error.exception), 'too many nested calls')
+
+    def test_redefinition(self):
+        # a call site resolved to a procedure sees its redefinitions
+        self.assertEqual(output(
+            '{ def f() { print 1; } i = 0;'
+            '  while (i < 3) { f(); if (i == 0) { def f() { print 2; } } i = i + 1; }'
+            '  def f() { print 3; } f(); }'), '1\n2\n2\n3\n')
+        # and so does a program run again, with fresh procedures
+        node = a5main.parse('{ f(); def f() { print 2; } f(); }')
+        for _ in range(2):
+            with self.assertRaises(a5main.EvalError):
+                a5main.run(node, a5main.Output(io.StringIO()))
+
+    def test_arity(self):
+        for source in ['{ def f(x) { print x; } f(1, 2); }',
+                       '{ def f(x) { print x; } f(); }',
+                       '{ def f(x) { print x; } f(1); def f(x, y) { print y; } f(2); }']:
+            with self.assertRaises(a5main.EvalError) as error:
+                output(source)
+            self.assertEqual(str(error.exception), 'wrong number of arguments to f')
+        self.assertEqual(output('{ def f(x) { print x; } f(1);'
+                                '  def f(x, y) { print y; } f(2, 3); }'), '1\n3\n')
+
+
+class DriverTest(unittest.TestCase):
+
+    def test_newlines_are_translated(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'crlf.ms')
+            with open(path, 'wb') as f:
+                f.write(b'{\r\n print "a\r\nb";\r\n}\r\n')
+            out = io.StringIO()
+            with contextlib.redirect_stdout(out):
+                a5main.main(['a5main.py', path, '-q'])
+        self.assertTrue(out.getvalue().endswith('a\nb\n'), out.getvalue())
+
+
+if __name__ == '__main__':
+    unittest.main()
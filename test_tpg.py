@@ -0,0 +1,155 @@
+"""Tests of the parsers generated by TPG.
+
+Run with: python -m unittest test_tpg
+"""
+
+import unittest
+
+import tpg
+
+
+LEXERS = ['NamedGroupLexer', 'Lexer', 'CacheNamedGroupLexer', 'CacheLexer',
+          'ContextSensitiveLexer']
+
+# The cache lexers lex ahead and the context sensitive lexer lexes on demand,
+# so they report other errors and the latter gives other marks.
+EXACT = ['NamedGroupLexer', 'Lexer', 'VerboseParser']
+
+
+def parsers(grammar):
+    """Return a parser of grammar for each lexer, and a verbose parser."""
+    made = {}
+    for lexer in LEXERS:
+        made[lexer] = type(lexer, (tpg.Parser,),
+                           {'__doc__': 'set lexer = %s\n%s' % (lexer, grammar)})()
+    verbose = type('Verbose', (tpg.VerboseParser,), {'__doc__': grammar})()
+    verbose.verbose = 0
+    made['VerboseParser'] = verbose
+    return made
+
+
+def results(parser, inputs):
+    """Return the result, or the error, of parser on each of inputs."""
+    found = []
+    for text in inputs:
+        try:
+            found.append(parser(text))
+        except tpg.Error as error:
+            found.append((type(error).__name__, error.line, error.column))
+    return found
+
+
+def failed(result):
+    """Tell whether result is an error returned by results."""
+    return isinstance(result, tuple) and result[0].endswith('Error')
+
+
+class GeneratorTest(unittest.TestCase):
+
+    def check(self, grammar, expected):
+        """Check that every parser of grammar gives the expected results,
+        a dictionary input -> result."""
+        inputs = list(expected)
+        for name, parser in parsers(grammar).items():
+            found = dict(zip(inputs, results(parser, inputs)))
+            if name in EXACT:
+                self.assertEqual(found, expected, name)
+                continue
+            for text in inputs:
+                if failed(expected[text]):
+                    self.assertTrue(failed(found[text]), (name, text))
+                elif name != 'ContextSensitiveLexer' or '@' not in grammar:
+                    self.assertEqual(found[text], expected[text], (name, text))
+
+    def test_factoring(self):
+        grammar = r"""
+            separator spaces: '\s+' ;
+            token ident: '[a-z]+' ;
+            START/r -> 'a' ident/x 'b' $ r = ('ab', x) $
+                     | 'a' ident/x 'c' $ r = ('ac', x) $
+                     | 'a' $ r = 'a' $
+                     | ident/x $ r = x $ ;
+            """
+        self.check(grammar, {
+            'a x b': ('ab', 'x'), 'a y c': ('ac', 'y'), 'a': 'a', 'z': 'z',
+            'a x d': ('SyntacticError', 1, 5), 'a x': ('SyntacticError', 1, 3),
+        })
+        # the shared prefix is parsed once
+        doc = parsers(grammar)['NamedGroupLexer'].START.__doc__
+        self.assertIn("'a' (ident ('b' | 'c') | ) | ident", doc)
+
+    def test_precedence_climbing(self):
+        grammar = r"""
+            separator spaces: '\s+' ;
+            token num: '\d+' int ;
+            START/e -> Sum/e ;
+            Sum/e -> Product/e ( '\+' Product/f $ e = ('+', e, f) $
+                               | '-' Product/f $ e = ('-', e, f) $ )* ;
+            Product/e -> Power/e ( '\*' Power/f $ e = ('*', e, f) $ )* ;
+            Power/e -> Unary/e ( '\^' Power/f $ e = ('^', e, f) $ )* ;
+            Unary/e -> '~' Unary/f $ e = ('~', f) $ | Atom/e ;
+            Atom/e -> num/e | '\(' Sum/e '\)' ;
+            """
+        self.check(grammar, {
+            '1 - 2 - 3': ('-', ('-', 1, 2), 3),
+            '1 + 2 * 3': ('+', 1, ('*', 2, 3)),
+            '1 * 2 + 3': ('+', ('*', 1, 2), 3),
+            '2 ^ 3 ^ 2': ('^', 2, ('^', 3, 2)),
+            '~ 2 ^ 3 * 4': ('*', ('^', ('~', 2), 3), 4),
+            '(1 + 2) * 3': ('*', ('+', 1, 2), 3),
+            '1 + * 2': ('SyntacticError', 1, 5),
+            '1 + 2)': ('SyntacticError', 1, 6),
+        })
+        self.assertTrue(any(name.startswith('_climb_')
+                            for name in dir(parsers(grammar)['NamedGroupLexer'])))
+
+    def test_keywords_and_identifiers(self):
+        grammar = r"""
+            separator spaces: '\s+' ;
+            token num: '\d+' int ;
+            token ident: '[a-zA-Z_]\w*' ;
+            START/l -> $ l = [] $ ( Word/w $ l.append(w) $ )* ;
+            Word/w -> 'if' $ w = 'IF' $ | 'print' $ w = 'PRINT' $
+                    | ident/w | num/w ;
+            """
+        self.check(grammar, {
+            'iff if print_ print': ['iff', 'IF', 'print_', 'PRINT'],
+            'ifprint if_ IF': ['ifprint', 'if_', 'IF'],
+            '12 print 3if': [12, 'PRINT', 3, 'if'],
+        })
+        parser = parsers(grammar)['NamedGroupLexer']
+        parser('if')
+        self.assertEqual(sorted(parser.lexer.keywords['ident']), ['if', 'print'])
+
+    def test_separators_between_tokens(self):
+        grammar = r"""
+            separator spaces: '\s+' ;
+            separator comment: '#.*' ;
+            token ident: '[a-z]+' ;
+            START/l -> $ l = [] $
+                       ( @t ident/x $ l.append((x, t.line, t.column)) $ )* ';' ;
+            """
+        self.check(grammar, {
+            'a b;': [('a', 1, 1), ('b', 1, 3)],
+            '  a # x y\n\t# z\n  bc  ;  # end': [('a', 1, 3), ('bc', 3, 3)],
+            'a\n  # c\n  b\n 1': ('LexicalError', 4, 2),
+            'a # ;\n': ('SyntacticError', 1, 1),
+        })
+
+    def test_long_sequences(self):
+        chunk = tpg.TPGParser.And.chunk
+        for n in [chunk, chunk + 1, 2 * chunk + 1, 60]:
+            grammar = r"""
+                separator spaces: '\s+' ;
+                token a: 'a' ;
+                START/l -> $ l = [] $ %s ;
+                """ % ' '.join(['a/x $ l.append(x) $'] * n)
+            self.check(grammar, {
+                'a ' * n: ['a'] * n,
+                'a ' * (n - 1): ('SyntacticError', 1, 2 * n - 3),
+                'a ' * n + 'a': ('SyntacticError', 1, 2 * n + 1),
+            })
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -53,6 +53,7 @@ __url__ = 'http://cdsoft.fr/tpg/'
 
 import parser
 import re
+import sre_compile
 import sre_parse
 import sys
 
@@ -148,6 +149,8 @@ class LexerOptions:
         if not wb:
             self.word_bounded = self.not_word_bounded
         self.compile_options = compile_options
+        self.kinds = {}                 # name -> kind
+        self.identifiers = set()        # names of the tokens whose texts are interned
 
     def re_compile(self, expr):
         """ compile expr using self.compile_options as re.compile options
@@ -167,18 +170,101 @@ class LexerOptions:
         """
         return expr
 
+    def def_kind(self, name, kind=None):
+        """ give a token or a separator its kind and return it
+
+        Kinds are small integers which generated parsers compare instead of
+        token names. Unless kind is given, kinds are numbered from 1 in the
+        order of the definitions. The kind of the end of file is 0.
+        """
+        if kind is None:
+            kind = len(self.kinds) + 1
+        self.kinds[name] = kind
+        return kind
+
+    def is_identifier(self, expr):
+        """ tell whether the tokens of expr are identifiers: words that do
+        not start with a digit
+        """
+        pattern = sre_parse.parse(expr, self.compile_options)
+        return self.word_only(pattern) and not self.re_compile(expr).match("0")
+
+    def word_only(self, pattern):
+        """ tell whether the parsed pattern only matches word characters
+        (False when not sure)
+        """
+        word = self.re_compile(r"\w")
+        for op, av in pattern:
+            if op is sre_parse.LITERAL:
+                if not word.match(chr(av)):
+                    return False
+            elif op is sre_parse.IN:
+                for op2, av2 in av:
+                    if op2 is sre_parse.LITERAL:
+                        if not word.match(chr(av2)):
+                            return False
+                    elif op2 is sre_parse.RANGE:
+                        lo, hi = av2
+                        if hi - lo > 0x100 or [c for c in range(lo, hi+1) if not word.match(chr(c))]:
+                            return False
+                    elif op2 is sre_parse.CATEGORY:
+                        if av2 not in (sre_parse.CATEGORY_WORD, sre_parse.CATEGORY_DIGIT):
+                            return False
+                    else:
+                        return False
+            elif op is sre_parse.SUBPATTERN and not av[1] and not av[2]:
+                if not self.word_only(av[-1]):
+                    return False
+            elif op is sre_parse.BRANCH:
+                for alternative in av[1]:
+                    if not self.word_only(alternative):
+                        return False
+            elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT):
+                if not self.word_only(av[2]):
+                    return False
+            else:
+                return False
+        return True
+
+    def reset_symbols(self):
+        """ start a new symbol table (done for each parse)
+        """
+        self.symbols = {}
+
+    def intern(self, text):
+        """ return the copy of text stored in the symbol table
+
+        The texts of identifiers are interned so that a name appearing many
+        times in the input is a single string object, which makes name
+        comparisons identity comparisons. Other tokens are not looked up.
+        """
+        symbol = self.symbols.get(text)
+        if symbol is None:
+            symbol = self.symbols[text] = text
+        return symbol
+
 class NamedGroupLexer(LexerOptions):
     r""" NamedGroupLexer(word_bounded, compile_options)
 
     NamedGroupLexer is a TPG lexer:
         - use named group regular expressions (faster but limited to 100 tokens)
+        - recognize keywords by looking up the texts of identifiers
+        - skip separators with the token they precede
 
     Attributes:
         token_re : regular expression containing the whole lexer
-        tokens   : dictionnary name -> (value, is_real_token)
+        tokens   : dictionnary name -> (value, is_real_token, kind)
                         name is a token name
                         value is a function that compute the value of a token from its text
                         is_real_token is a boleean. True for tokens, False for separators
+                        kind is the integer kind of the token
+        keywords : dictionnary name -> text -> (keyword, value, kind, regexp)
+                        name is the name of an identifier token
+                        text is the text of a keyword matched by this token
+                        keyword, value and kind describe the keyword token
+                        regexp is the regular expression of the keyword
+        skipped  : set of the names of the separators skipped with the tokens
+        separator_re : regular expression of a sequence of skipped separators
     Once the lexer is started more attributes are defined:
         input      : input string being parsed
         max_pos    : maximum position reached in the input string
@@ -187,20 +273,25 @@ class NamedGroupLexer(LexerOptions):
         line       : line of the current token
         column     : column of the current token
         cur_token  : current token
+        symbols    : symbol table interning the texts of the identifiers
     """
 
     def __init__(self, wb, compile_options):
         LexerOptions.__init__(self, wb, compile_options)
-        self.token_re = []              # [named_regexp] and then regexp
-        self.tokens = {}                # name -> value, is_real_token
+        self.token_re = []              # [(name, expr)] and then regexp
+        self.tokens = {}                # name -> value, is_real_token, kind
+        self.keywords = {}              # name -> text -> keyword, value, kind, regexp
+        self.skipped = set()            # names of the separators skipped with the tokens
+        self.separator_re = None
 
-    def def_token(self, name, expr, value=_id):
+    def def_token(self, name, expr, value=_id, kind=None):
         """ add a new token to the lexer
 
         Parameters:
             name : name of the token
             expr : regular expression of the token
             value : function to compute the token value from its text
+            kind : integer kind of the token (see def_kind)
 
         The default for value is the identity function. If value is not callable
         it is returned whatever the text of the token.
@@ -208,18 +299,21 @@ class NamedGroupLexer(LexerOptions):
         if not callable(value):
             value = lambda _, value=value: value
         if name not in self.tokens:
-            self.token_re.append("(?P<%s>%s)"%(name, self.word_bounded(expr)))
-            self.tokens[name] = value, True
+            self.token_re.append((name, self.word_bounded(expr)))
+            self.tokens[name] = value, True, self.def_kind(name, kind)
+            if self.is_identifier(expr):
+                self.identifiers.add(name)
         else:
             raise SemanticError("Duplicate token definition (%s)"%name)
 
-    def def_separator(self, name, expr, value=_id):
+    def def_separator(self, name, expr, value=_id, kind=None):
         """ add a new separator to the lexer
 
         Parameters:
             name : name of the separator
             expr : regular expression of the separator
             value : function to compute the separator value from its text
+            kind : integer kind of the separator (see def_kind)
 
         The default for value is the identity function. If value is not callable
         it is returned whatever the text of the separator. Note that separator
@@ -228,8 +322,8 @@ class NamedGroupLexer(LexerOptions):
         if not callable(value):
             value = lambda _, value=value: value
         if name not in self.tokens:
-            self.token_re.append("(?P<%s>%s)"%(name, self.word_bounded(expr)))
-            self.tokens[name] = value, False
+            self.token_re.append((name, self.word_bounded(expr)))
+            self.tokens[name] = value, False, self.def_kind(name, kind)
         else:
             raise SemanticError("Duplicate token definition (%s)"%name)
 
@@ -237,7 +331,149 @@ class NamedGroupLexer(LexerOptions):
         """ build the token_re attribute from the tokens and separators
         """
         if isinstance(self.token_re, list):
-            self.token_re = self.re_compile("|".join(self.token_re))
+            self.find_keywords()
+            self.find_skipped()
+            token_re = "|".join([
+                "(?P<%s>%s)"%(name, expr)
+                for name, expr in self.token_re
+                if name not in self.keyword_names and name not in self.skipped
+            ])
+            if self.skipped:
+                separators = "(?:%s)*"%"|".join([
+                    "(?:%s)"%expr
+                    for name, expr in self.token_re
+                    if name in self.skipped
+                ])
+                # the lookahead makes the separators atomic, so that the
+                # separators before a lexical error are not backtracked
+                token_re = "(?=(?P<_separators>%s))(?P=_separators)(?:%s)"%(separators, token_re)
+                self.separator_re = self.re_compile(separators)
+            self.token_re = self.re_compile(token_re)
+
+    keyword_re = re.compile(r"^\\b(\w+)\\b$")
+
+    def find_keywords(self):
+        """ fill the keywords table with the word bounded words that the
+        following identifier token also matches
+
+        These keywords are left out of token_re: the text of an identifier
+        is looked up in the table and, when it is a keyword whose regular
+        expression matches at its position, the token is the keyword.
+        This gives the same tokens as long as no token between a keyword
+        and the identifier token may start like the keyword and the
+        identifier only matches word characters.
+        """
+        self.keyword_names = set()
+        if self.compile_options & re.IGNORECASE:
+            return
+        exprs = self.token_re
+        for i in range(len(exprs)):
+            name, expr = exprs[i]
+            word = self.keyword_re.match(expr)
+            if word is None or not self.tokens[name][1]:
+                continue
+            word = word.group(1)
+            for other, other_expr in exprs[i+1:]:
+                if other in self.keyword_names or self.keyword_re.match(other_expr):
+                    continue
+                pattern = sre_parse.parse(other_expr, self.compile_options)
+                match = self.re_compile(other_expr).match(word)
+                if match is not None and match.end() == len(word):
+                    if self.tokens[other][1] and self.word_only(pattern):
+                        value, real_token, kind = self.tokens[name]
+                        self.keywords.setdefault(other, {})[word] = name, value, kind, self.re_compile(expr)
+                        self.keyword_names.add(name)
+                    break
+                if self.may_start(pattern, word[0]):
+                    break
+
+    def find_skipped(self):
+        """ fill skipped with the separators that can be skipped with the
+        token they precede
+
+        These are the separators whose value is the default one, when no
+        token or separator defined before them may start like them; then
+        the separators at a position are those the named groups would
+        have matched one by one.
+        """
+        for i in range(len(self.token_re)):
+            name, expr = self.token_re[i]
+            value, real_token, kind = self.tokens[name]
+            if real_token or value is not _id:
+                continue
+            chars = self.first_chars(sre_parse.parse(expr, self.compile_options))
+            if chars is None:
+                continue
+            for other, other_expr in self.token_re[:i]:
+                if other in self.keyword_names or other in self.skipped:
+                    continue
+                first = self.first_re(sre_parse.parse(other_expr, self.compile_options))
+                if first is None or first.search(chars):
+                    break
+            else:
+                self.skipped.add(name)
+
+    bmp = None      # all the characters of the Basic Multilingual Plane
+
+    def first_chars(self, pattern):
+        """ return the characters of the Basic Multilingual Plane a match of
+        the parsed pattern may start with (None when not sure)
+        """
+        first = self.first_re(pattern)
+        if first is None:
+            return None
+        if NamedGroupLexer.bmp is None:
+            NamedGroupLexer.bmp = "".join(map(chr, range(0x10000)))
+        return "".join(first.findall(NamedGroupLexer.bmp))
+
+    def may_start(self, pattern, char):
+        """ tell whether a match of the parsed pattern may start with char
+        (True when not sure)
+        """
+        first = self.first_re(pattern)
+        return first is None or first.match(char) is not None
+
+    def first_re(self, pattern):
+        """ return a regular expression matching a character a match of
+        the parsed pattern may start with (None when not sure, or when the
+        pattern may match the empty string)
+        """
+        def first(pattern):
+            # items that may match the first character, and nullability
+            items = []
+            for op, av in pattern:
+                if op in (sre_parse.LITERAL, sre_parse.NOT_LITERAL, sre_parse.IN, sre_parse.ANY):
+                    items.append((op, av))
+                    return items, False
+                elif op in (sre_parse.AT, sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+                    continue
+                elif op is sre_parse.SUBPATTERN and not av[1] and not av[2]:
+                    sub = first(av[-1])
+                elif op is sre_parse.BRANCH:
+                    sub = [], False
+                    for alternative in av[1]:
+                        alt = first(alternative)
+                        if alt is None:
+                            return None
+                        sub = sub[0] + alt[0], sub[1] or alt[1]
+                elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT):
+                    sub = first(av[2])
+                    if sub is not None and av[0] == 0:
+                        sub = sub[0], True
+                else:
+                    return None
+                if sub is None:
+                    return None
+                items.extend(sub[0])
+                if not sub[1]:
+                    return items, False
+            return items, True
+        items = first(pattern)
+        if items is None or items[1]:
+            return None
+        branch = [sre_parse.SubPattern(pattern.state, [item]) for item in items[0]]
+        sub = sre_parse.SubPattern(pattern.state, [(sre_parse.BRANCH, (None, branch))])
+        return sre_compile.compile(sub, self.compile_options)
 
     def start(self, input):
         """ start a lexical analysis
@@ -246,6 +482,7 @@ class NamedGroupLexer(LexerOptions):
             input : input string to be parsed
         """
         self.input = input
+        self.reset_symbols()
         self.max_pos = 0
         self.last_token = None
         self.build()
@@ -285,13 +522,22 @@ class NamedGroupLexer(LexerOptions):
             tok = self.token_re.match(self.input, self.pos)
             if tok:
                 name = tok.lastgroup
-                text = tok.group()
-                value, real_token = self.tokens[name]
+                start, stop = tok.span(name)
+                if start > self.pos:
+                    self.skip(start)
+                text = tok.group(name)
+                value, real_token, kind = self.tokens[name]
+                if real_token:
+                    if name in self.identifiers:
+                        text = self.intern(text)
+                    if name in self.keywords:
+                        keyword = self.keywords[name].get(text)
+                        if keyword is not None and keyword[3].match(self.input, start):
+                            name, value, kind = keyword[:3]
                 try:
                     value = value(text)
                 except WrongToken:
                     raise LexicalError((self.line, self.column), "Lexical error in %s"%text)
-                start, stop = tok.span()
                 self.pos = stop
                 tok_line, tok_column = self.line, self.column
                 if '\n' in text:
@@ -300,12 +546,18 @@ class NamedGroupLexer(LexerOptions):
                 else:
                     self.column += len(text)
                 if real_token:
-                    self.cur_token = Token(name, text, value, tok_line, tok_column, self.line, self.column, start, stop, prev_stop)
+                    self.cur_token = Token(name, text, value, tok_line, tok_column, self.line, self.column, start, stop, prev_stop, kind)
                     if self.pos > self.max_pos:
                         self.max_pos = self.pos
                         self.last_token = self.cur_token
                     return self.cur_token
             else:
+                if self.separator_re is not None:
+                    # separators before the end of file or an error
+                    stop = self.separator_re.match(self.input, self.pos).end()
+                    if stop > self.pos:
+                        self.skip(stop)
+                        continue
                 w = 20
                 nl = self.input.find('\n', self.pos, self.pos+w)
                 if nl > -1:
@@ -314,6 +566,17 @@ class NamedGroupLexer(LexerOptions):
                     err = self.input[self.pos:self.pos+w]
                 raise LexicalError((self.line, self.column), "Lexical error near %s"%err)
 
+    def skip(self, pos):
+        """ move to pos over skipped separators, counting their lines
+        """
+        nl = self.input.count('\n', self.pos, pos)
+        if nl:
+            self.line += nl
+            self.column = pos - self.input.rfind('\n', self.pos, pos)
+        else:
+            self.column += pos - self.pos
+        self.pos = pos
+
     def token(self):
         """ return the current token
         """
@@ -337,11 +600,12 @@ class Lexer(NamedGroupLexer):
         - select the longuest match so the order of token definitions doesn't mater
 
     Attributes:
-        tokens : list (name, regexp, value, is_real_token)
+        tokens : list (name, regexp, value, is_real_token, kind)
                         name is a token name
                         regexp is the regular expression of the token
                         value is a function that computes the value of a token from its text
                         is_real_token is a boleean. True for tokens, False for separators
+                        kind is the integer kind of the token
     Once the lexer is started more attributes are defined:
         input      : input string being parsed
         max_pos    : maximum position reached in the input string
@@ -354,15 +618,16 @@ class Lexer(NamedGroupLexer):
 
     def __init__(self, wb, compile_options):
         LexerOptions.__init__(self, wb, compile_options)
-        self.tokens = []        # [(name, regexp, value, is_real_token)]
+        self.tokens = []        # [(name, regexp, value, is_real_token, kind)]
 
-    def def_token(self, name, expr, value=_id):
+    def def_token(self, name, expr, value=_id, kind=None):
         """ adds a new token to the lexer
 
         Parameters:
             name : name of the token
             expr : regular expression of the token
             value : function to compute the token value from its text
+            kind : integer kind of the token (see def_kind)
 
         The default for value is the identity function. If value is not callable
         it is returned whatever the text of the token.
@@ -370,17 +635,20 @@ class Lexer(NamedGroupLexer):
         if not callable(value):
             value = lambda _, value=value: value
         if name not in self.tokens:
-            self.tokens.append((name, self.re_compile(self.word_bounded(expr)), value, True))
+            self.tokens.append((name, self.re_compile(self.word_bounded(expr)), value, True, self.def_kind(name, kind)))
+            if self.is_identifier(expr):
+                self.identifiers.add(name)
         else:
             raise SemanticError("Duplicate token definition (%s)"%name)
 
-    def def_separator(self, name, expr, value=_id):
+    def def_separator(self, name, expr, value=_id, kind=None):
         """ add a new separator to the lexer
 
         Parameters:
             name : name of the separator
             expr : regular expression of the separator
             value : function to compute the separator value from its text
+            kind : integer kind of the separator (see def_kind)
 
         The default for value is the identity function. If value is not callable
         it is returned whatever the text of the separator. Note that separator
@@ -389,7 +657,7 @@ class Lexer(NamedGroupLexer):
         if not callable(value):
             value = lambda _, value=value: value
         if name not in self.tokens:
-            self.tokens.append((name, self.re_compile(self.word_bounded(expr)), value, False))
+            self.tokens.append((name, self.re_compile(self.word_bounded(expr)), value, False, self.def_kind(name, kind)))
         else:
             raise SemanticError("Duplicate token definition (%s)"%name)
 
@@ -400,6 +668,7 @@ class Lexer(NamedGroupLexer):
             input : input string to be parsed
         """
         self.input = input
+        self.reset_symbols()
         self.max_pos = 0
         self.last_token = None
         self.back(None)
@@ -420,7 +689,7 @@ class Lexer(NamedGroupLexer):
                 return self.cur_token
             tok = None
             text = ""
-            for _name, _regexp, _value, _is_real_token in self.tokens:
+            for _name, _regexp, _value, _is_real_token, _kind in self.tokens:
                 _tok = _regexp.match(self.input, self.pos)
                 if _tok:
                     _text = _tok.group()
@@ -430,7 +699,10 @@ class Lexer(NamedGroupLexer):
                         text = _text
                         value = _value
                         real_token = _is_real_token
+                        kind = _kind
             if tok:
+                if name in self.identifiers:
+                    text = self.intern(text)
                 try:
                     value = value(text)
                 except WrongToken:
@@ -444,7 +716,7 @@ class Lexer(NamedGroupLexer):
                 else:
                     self.column += len(text)
                 if real_token:
-                    self.cur_token = Token(name, text, value, tok_line, tok_column, self.line, self.column, start, stop, prev_stop)
+                    self.cur_token = Token(name, text, value, tok_line, tok_column, self.line, self.column, start, stop, prev_stop, kind)
                     if self.pos > self.max_pos:
                         self.max_pos = self.pos
                         self.last_token = self.cur_token
@@ -494,6 +766,7 @@ class CacheNamedGroupLexer(NamedGroupLexer):
         """
         self.cache = []
         self.input = input
+        self.reset_symbols()
         self.max_pos = 0
         self.last_token = None
         self.build()
@@ -538,11 +811,12 @@ class CacheLexer(Lexer):
           (faster with very ambigous grammars but needs more memory)
 
     Attributes:
-        tokens : list (name, regexp, value, is_real_token)
+        tokens : list (name, regexp, value, is_real_token, kind)
                         name is a token name
                         regexp is the regular expression of the token
                         value is a function that computes the value of a token from its text
                         is_real_token is a boleean. True for tokens, False for separators
+                        kind is the integer kind of the token
         cache  : token list
     Once the lexer is started more attributes are defined:
         input      : input string being parsed
@@ -565,6 +839,7 @@ class CacheLexer(Lexer):
         """
         self.cache = []
         self.input = input
+        self.reset_symbols()
         self.max_pos = 0
         self.last_token = None
         self.back(None)
@@ -609,6 +884,7 @@ class ContextSensitiveLexer(LexerOptions):
                         name is a token name
                         regexp is the regular expression of the token
                         value is a function that computes the value of a token from its text
+        kind_tokens : dictionnary kind -> (name, regexp, value)
         separators : list (name, regexp, value)
                         name is a token name
                         regexp is the regular expression of the token
@@ -626,15 +902,17 @@ class ContextSensitiveLexer(LexerOptions):
     def __init__(self, wb, compile_options):
         LexerOptions.__init__(self, wb, compile_options)
         self.tokens = {}                # name -> (regexp, value)
+        self.kind_tokens = {}           # kind -> (name, regexp, value)
         self.separators = []            # [(name, regexp, value)]
 
-    def def_token(self, name, expr, value=_id):
+    def def_token(self, name, expr, value=_id, kind=None):
         """ add a new token to the lexer
 
         Parameters:
             name : name of the token
             expr : regular expression of the token
             value : function to compute the token value from its text
+            kind : integer kind of the token (see def_kind)
 
         The default for value is the identity function. If value is not callable
         it is returned whatever the text of the token.
@@ -643,16 +921,20 @@ class ContextSensitiveLexer(LexerOptions):
             value = lambda _, value=value: value
         if name not in self.tokens and name not in self.separators:
             self.tokens[name] = self.re_compile(self.word_bounded(expr)), value
+            self.kind_tokens[self.def_kind(name, kind)] = (name,) + self.tokens[name]
+            if self.is_identifier(expr):
+                self.identifiers.add(name)
         else:
             raise SemanticError("Duplicate token definition (%s)"%name)
 
-    def def_separator(self, name, expr, value=_id):
+    def def_separator(self, name, expr, value=_id, kind=None):
         """ add a new separator to the lexer
 
         Parameters:
             name : name of the separator
             expr : regular expression of the separator
             value : function to compute the separator value from its text
+            kind : integer kind of the separator (see def_kind)
 
         The default for value is the identity function. If value is not callable
         it is returned whatever the text of the separator. Note that separator
@@ -662,6 +944,7 @@ class ContextSensitiveLexer(LexerOptions):
             value = lambda _, value=value: value
         if name not in self.tokens and name not in self.separators:
             self.separators.append((name, self.re_compile(self.word_bounded(expr)), value))
+            self.def_kind(name, kind)
         else:
             raise SemanticError("Duplicate token definition (%s)"%name)
 
@@ -672,6 +955,7 @@ class ContextSensitiveLexer(LexerOptions):
             input : input string to be parsed
         """
         self.input = input
+        self.reset_symbols()
         self.max_pos = 0
         self.last_token = None
         self.back(None)
@@ -716,12 +1000,20 @@ class ContextSensitiveLexer(LexerOptions):
                     done = False
 
     def eat(self, name):
-        """ return the next token value if it matches the expected token name
+        """ return the next token if it matches the expected token name
         """
-        regexp, value = self.tokens[name]
+        token = self.accept(self.kinds[name])
+        if token is None:
+            raise WrongToken
+        return token
+
+    def accept(self, kind):
+        """ return the next token if it is of the expected kind, None otherwise
+        """
+        name, regexp, value = self.kind_tokens[kind]
         tok = regexp.match(self.input, self.pos)
         if tok is None:
-            raise WrongToken
+            return None
         else:
             if self.cur_token is None:
                 prev_stop = 0
@@ -729,6 +1021,8 @@ class ContextSensitiveLexer(LexerOptions):
                 prev_stop = self.cur_token.stop
             start, stop = tok.span()
             text = self.input[start:stop]
+            if name in self.identifiers:
+                text = self.intern(text)
             value = value(text)
             self.pos = stop
             tok_line, tok_column = self.line, self.column
@@ -737,7 +1031,7 @@ class ContextSensitiveLexer(LexerOptions):
                 self.column = len(text) - text.rfind('\n')
             else:
                 self.column += len(text)
-            self.cur_token = Token(name, text, value, tok_line, tok_column, self.line, self.column, start, stop, prev_stop)
+            self.cur_token = Token(name, text, value, tok_line, tok_column, self.line, self.column, start, stop, prev_stop, kind)
             if self.pos > self.max_pos:
                 self.max_pos = self.pos
                 self.last_token = self.cur_token
@@ -762,12 +1056,13 @@ class ContextSensitiveLexer(LexerOptions):
         return self.input[start:stop]
 
 class Token:
-    """ Token(name, text, value, line, column, end_line, end_column, start, stop, prev_stop)
+    """ Token(name, text, value, line, column, end_line, end_column, start, stop, prev_stop, kind)
 
     Token object used by lexers
 
     Attributes:
         name       : name of the token
+        kind       : integer kind of the token
         text       : text matched by the regular expression
         value      : value computed from the text
         line       : line of the token in the input string
@@ -779,8 +1074,9 @@ class Token:
         prev_stop  : position of the end of the previous token
     """
 
-    def __init__(self, name, text, value, line, column, end_line, end_column, start, stop, prev_stop):
+    def __init__(self, name, text, value, line, column, end_line, end_column, start, stop, prev_stop, kind=None):
         self.name = name
+        self.kind = kind
         self.text = text
         self.value = value
         self.line, self.column = line, column
@@ -807,6 +1103,7 @@ class EOFToken(Token):
 
     Attributes:
         name       : name of the token
+        kind       : kind of the token (0)
         text       : text matched by the regular expression
         value      : value computed from the text
         line       : line of the token in the input string
@@ -819,7 +1116,7 @@ class EOFToken(Token):
     """
 
     def __init__(self, line, column, pos, prev_stop):
-        Token.__init__(self, "EOF", "EOF", None, line, column, line, column, pos, pos, prev_stop)
+        Token.__init__(self, "EOF", "EOF", None, line, column, line, column, pos, pos, prev_stop, 0)
 
 class SOFToken(Token):
     """ SOFToken()
@@ -829,6 +1126,7 @@ class SOFToken(Token):
 
     Attributes:
         name       : name of the token
+        kind       : kind of the token (-1)
         text       : text matched by the regular expression
         value      : value computed from the text
         line       : line of the token in the input string
@@ -841,7 +1139,7 @@ class SOFToken(Token):
     """
 
     def __init__(self):
-        Token.__init__(self, "SOF", "SOF", None, 1, 1, 1, 1, 0, 0, 0)
+        Token.__init__(self, "SOF", "SOF", None, 1, 1, 1, 1, 0, 0, 0, -1)
 
 class Py:
     def __init__(self, level=0):
@@ -869,6 +1167,7 @@ class ParserMetaClass(type):
             pass
         else:
             parser = TPGParser(sys._getframe(1).f_globals)
+            parser.verbose = hasattr(cls, 'token_info')
             for attribute, source, code in parser(grammar):
                 setattr(cls, attribute, code)
 
@@ -1147,6 +1446,7 @@ class VerboseParser(Parser):
 
 blank_line_re = re.compile("^\s*$")
 indent_re = re.compile("^\s*")
+ident_re = re.compile(r"^[A-Za-z_]\w*$")
 
 class tpg:
     """ This class contains some TPG classes to make the parsers usable inside and outside the tpg module
@@ -1247,7 +1547,7 @@ class TPGParser(tpg.Parser):
 
     HEAD/$self.Symbol(name, args, ret)$ -> ident/name OPT_ARGS/args RET<$self.PY_Ident(name)$>/ret ;
 
-    OR_EXPR/$self.balance(or_expr)$ ->
+    OR_EXPR/$self.alternatives(or_expr)$ ->
         AND_EXPR/a                  $ or_expr = [a]
         (   check $ not or_expr[-1].empty() $
             '\|' AND_EXPR/a         $ or_expr.append(a)
@@ -1491,7 +1791,7 @@ class TPGParser(tpg.Parser):
             except tpg.WrongToken:
                 self.lexer.back(_p1)
                 break
-        return self.balance(or_expr)
+        return self.alternatives(or_expr)
 
     def AND_EXPR(self, ):
         r""" ``AND_EXPR -> (ATOM_EXPR REP)* ;`` """
@@ -1814,11 +2114,21 @@ class TPGParser(tpg.Parser):
         def get_inline_tokens(self):
             return
             yield None
-        def gen_code(self, indent=None, counters=None, pos=None):
+        def first(self, firsts):
+            return frozenset(), True
+        def gen_code(self, indent=None, counters=None, pos=None, k=None):
             if indent is None:
                 return self.code.strip()
             else:
-                return [indent+line for line in self.code.splitlines()]
+                # semantic code may backtrack by raising WrongToken
+                return [
+                    indent + "try:",
+                    [indent+tab+line for line in self.code.splitlines()],
+                    indent + "except tpg.WrongToken:",
+                    indent + tab + "pass",
+                    indent + "else:",
+                    k(indent+tab),
+                ]
         def links_symbols_to_tokens(self, tokens):
             pass
         def gen_doc(self, parent):
@@ -1836,10 +2146,10 @@ class TPGParser(tpg.Parser):
         def gen_def(self):
             expr = self.expr
             if self.code is None:
-                return "lexer.%s('%s', %s%s)"%(self.def_method, self.name, self.string_prefix, expr)
+                return "lexer.%s('%s', %s%s, kind=%d)"%(self.def_method, self.name, self.string_prefix, expr, self.kind)
             else:
                 code = self.code.gen_code().strip()
-                return "lexer.%s('%s', %s%s, %s)"%(self.def_method, self.name, self.string_prefix, expr, code)
+                return "lexer.%s('%s', %s%s, %s, %d)"%(self.def_method, self.name, self.string_prefix, expr, code, self.kind)
 
     class DefSeparator(DefToken):
         def_method = "def_separator"
@@ -1852,9 +2162,79 @@ class TPGParser(tpg.Parser):
         def links_symbols_to_tokens(self, tokens):
             for rule in self:
                 rule.links_symbols_to_tokens(tokens)
-        def gen_code(self):
+        def firsts(self):
+            """ return the dictionnary name -> (kinds, nullable) giving for
+            each rule the kinds of the tokens its matches start with (None
+            if unknown) and whether it may match the empty string """
+            firsts = dict((rule.head.name, (frozenset(), False)) for rule in self)
+            changed = True
+            while changed:
+                changed = False
+                for rule in self:
+                    first = rule.body.first(firsts)
+                    if first != firsts[rule.head.name]:
+                        firsts[rule.head.name] = first
+                        changed = True
+            return firsts
+        def chains(self, firsts):
+            """ return the precedence chains of the grammar
+
+            A chain is a sequence of rules R0 -> R1 -> ... -> Rn -> B where
+            each rule is a level (see Rule.level) whose operand is the next
+            one and B, the bottom of the chain, is any other symbol.  The
+            kinds starting the operators of a chain must be known and
+            distinct, and prefix operators must not start like B. """
+            levels = {}
+            preds = {}
             for rule in self:
-                yield rule.gen_code()
+                level = rule.level(firsts)
+                if level is not None:
+                    levels[rule.head.name] = rule, level
+                    preds[level[0]] = preds.get(level[0], 0) + 1
+            chains = []
+            for name in levels:
+                if preds.get(name) == 1:
+                    continue    # the rule continues the chain of another level
+                chain = []
+                while name in levels and name not in [rule.head.name for rule, level in chain]:
+                    chain.append(levels[name])
+                    name = levels[name][1][0]
+                    if preds.get(name) != 1:
+                        break
+                bottom = chain[-1][1][0]
+                operators = [branch for rule, level in chain for branch in level[1] + level[2]]
+                guards = [TPGParser.guard(branch, firsts) for branch in operators]
+                if not operators or None in guards:
+                    continue
+                kinds = frozenset().union(*guards)
+                if sum([len(k) for k in guards]) != len(kinds):
+                    continue    # operators of several levels start alike
+                bottom_kinds = firsts.get(bottom, (None, True))[0]
+                prefixes = [TPGParser.guard(branch, firsts) for rule, level in chain for branch in level[2]]
+                if prefixes and (bottom_kinds is None or [k for k in prefixes if k & bottom_kinds]):
+                    continue    # a prefix operator may start an operand
+                chains.append(TPGParser.Chain([rule for rule, level in chain], bottom, firsts))
+            return chains
+        def gen_code(self, eat):
+            firsts = self.firsts()
+            # rules inlined at their calls, except for verbose parsers which
+            # report the calls
+            inlines = {}
+            if eat != 'eat':
+                for rule in self:
+                    if rule.inline(rule.head.ret) is not None:
+                        inlines[rule.head.name] = rule
+            climbs = {}
+            if eat == 'inline':
+                for chain in self.chains(firsts):
+                    yield chain.gen_code(inlines)
+                    for i, rule in enumerate(chain.rules):
+                        climbs[rule.head.name] = chain, i
+            for rule in self:
+                if rule.head.name in climbs:
+                    yield rule.gen_climb(*climbs[rule.head.name])
+                else:
+                    yield rule.gen_code(eat, firsts, inlines)
 
     class Rule:
         class Counters(dict):
@@ -1873,14 +2253,194 @@ class TPGParser(tpg.Parser):
                 raise SemanticError("%s is both a token and a symbol"%self.head.name)
             else:
                 self.body.links_symbols_to_tokens(tokens)
-        def gen_code(self):
+        def gen_code(self, eat, firsts, inlines):
+            # The code of an expression is given the code k to run when the
+            # expression matches; when it does not, the code falls through,
+            # and the rule raises WrongToken if no alternative matched.
             counters = self.Counters()
+            counters.eat = eat
+            counters.firsts = firsts
+            counters.inlines = inlines
+            counters.known = {}
+            body = self.body.gen_code(tab, counters, None, lambda indent: self.head.gen_ret(indent) or indent + "return")
             return self.head.name, [
                 self.head.gen_def(),
                 tab + 'r""" ``%s -> %s ;`` """'%(self.head.gen_doc(self), self.body.gen_doc(self)),
+                TPGParser.gen_locals(tab, body),
                 self.head.gen_init_ret(tab),
-                self.body.gen_code(tab, counters, None),
-                self.head.gen_ret(tab),
+                body,
+                tab + "raise tpg.WrongToken",
+            ]
+        def inline(self, ret):
+            """ return an expression matching the rule in place of a call
+            binding ret, or None if the rule can not be inlined
+
+            Only rules matching one of some tokens, each giving the value of
+            the rule, are inlined: their code can not clash with the local
+            variables of the caller. """
+            head = self.head
+            if head.args or head.ret is None:
+                return None
+            body = self.body
+            tokens = []
+            for a in isinstance(body, TPGParser.Or) and body.alternatives or [body]:
+                if isinstance(a, TPGParser.And) and len(a) == 1:
+                    a = a[0]
+                if a.__class__ not in (TPGParser.InlineToken, TPGParser.Symbol) or getattr(a, 'token', False) is None:
+                    return None
+                if a.ret is None or a.ret.gen_code() != head.ret.gen_code():
+                    return None
+                if isinstance(a, TPGParser.InlineToken):
+                    token = TPGParser.InlineToken(a.expr, ret)
+                    token.set_explicit_token(a.explicit_token)
+                else:
+                    token = TPGParser.Symbol(a.name, a.args, ret)
+                    token.token = a.token
+                tokens.append(token)
+            if len(tokens) == 1:
+                return tokens[0]
+            return TPGParser.Or(tokens)
+        def level(self, firsts):
+            """ return (operand, operators, prefixes) if the rule is a level
+            of a precedence chain, i.e. it is one of
+
+                R/e -> N/e ;
+                R/e -> N/e ( X1 | X2 | ... )* ;
+                R/e -> X1 | X2 | ... | N/e ;
+
+            where N, the operand, is a symbol without arguments and the
+            operators X are alternatives starting with tokens.  Operators
+            of the second form are binary (when they contain N) or postfix,
+            those of the third are prefix.  Return None otherwise. """
+            head = self.head
+            if head.args or not isinstance(head.ret, TPGParser.PY_Ident) or not ident_re.match(head.ret):
+                return None
+            def operand(a):
+                if isinstance(a, TPGParser.And) and len(a) == 1:
+                    a = a[0]
+                if isinstance(a, TPGParser.Symbol) and a.token is None and not a.args and a.ret == head.ret:
+                    return a.name
+            def branches(a):
+                return isinstance(a, TPGParser.Or) and list(a.alternatives) or [a]
+            body = self.body
+            if operand(body) is not None:
+                return operand(body), [], []
+            if isinstance(body, TPGParser.And) and len(body) == 2 and operand(body[0]) is not None:
+                rep = body[1]
+                if isinstance(rep, TPGParser.Rep) and (rep.min, rep.max) == (0, None):
+                    return operand(body[0]), branches(rep.a), []
+            if isinstance(body, TPGParser.Or) and operand(body.alternatives[-1]) is not None:
+                return operand(body.alternatives[-1]), [], body.alternatives[:-1]
+            return None
+        def gen_climb(self, chain, level):
+            return self.head.name, [
+                self.head.gen_def(),
+                tab + 'r""" ``%s -> %s ;`` """'%(self.head.gen_doc(self), self.body.gen_doc(self)),
+                tab + "return self.%s(%d)"%(chain.name, level),
+            ]
+
+    class Chain:
+        """ precedence climbing routine parsing the levels of a chain
+
+        The rule of level i parses its operand, then the operators of any
+        level >= i, whose right operands are parsed from the level above
+        (or from the same level for prefix operators).  The actions of the
+        levels run in the routine and share its local variables. """
+        def __init__(self, rules, bottom, firsts):
+            self.rules = rules
+            self.bottom = bottom
+            self.firsts = firsts
+            self.name = "_climb_%s"%rules[0].head.name
+            self.levels = [rule.level(firsts) for rule in rules]
+            rets = set([rule.head.ret for rule in rules])
+            self.acc = len(rets) == 1 and rets.pop() or "_e"
+        def operand(self, branch, name, level):
+            """ branch with the calls to the rule name parsing the level """
+            if not isinstance(branch, TPGParser.And):
+                branch = TPGParser.And([branch])
+            names = [rule.head.name for rule in self.rules]
+            if name not in names:
+                return branch
+            return TPGParser.And([
+                isinstance(a, TPGParser.Symbol) and a.name == name and not a.args
+                    and TPGParser.Climb(self.name, level, a.ret) or a
+                for a in branch
+            ])
+        def gen_branch(self, indent, counters, p, test, level, branch, operand, k):
+            ret = self.rules[level].head.ret
+            prefix = operand == self.rules[level].head.name
+            return [
+                indent + test,
+                ret != self.acc and not prefix and indent + tab + "%s = %s"%(ret, self.acc) or (),
+                TPGParser.gen_known(self.operand(branch, operand, prefix and level or level+1), indent+tab, counters, p,
+                    TPGParser.guard(branch, self.firsts),
+                    lambda indent: [ret != self.acc and indent + "%s = %s"%(self.acc, ret) or (), k(indent)]),
+            ]
+        def gen_code(self, inlines):
+            counters = TPGParser.Rule.Counters()
+            counters.eat = 'inline'
+            counters.firsts = self.firsts
+            counters.inlines = inlines
+            counters.known = {}
+            p = counters("p")
+            ok = counters("ok")
+            code = [
+                "def %s(self, level):"%self.name,
+                tab + 'r""" ``%s`` """'%" -> ".join([rule.head.name for rule in self.rules] + [self.bottom]),
+                tab + "_lexer = self.lexer",
+            ]
+            prefixes = [(i, branch) for i, level in enumerate(self.levels) for branch in level[2]]
+            operators = [(i, branch) for i, level in enumerate(self.levels) for branch in level[1]]
+            def test(keyword, p, i, branch):
+                kinds = TPGParser.gen_kind_test(p, TPGParser.guard(branch, self.firsts))
+                return "%s %s%s:"%(keyword, i and "level <= %d and "%i or "", kinds)
+            if prefixes:
+                code.append([
+                    tab + "%s = _lexer.cur_token"%p,
+                    tab + "%s = False"%ok,
+                    [ self.gen_branch(tab, counters, p, test(n and "elif" or "if", p, i, branch), i, branch,
+                                      self.rules[i].head.name, lambda indent: indent + "%s = True"%ok)
+                      for n, (i, branch) in enumerate(prefixes) ],
+                    tab + "if not %s:"%ok,
+                    tab + tab + "_lexer.back(%s)"%p,
+                    tab + tab + "%s = self.%s()"%(self.acc, self.bottom),
+                ])
+            else:
+                code.append(tab + "%s = self.%s()"%(self.acc, self.bottom))
+            p = counters("p")
+            kinds = frozenset()
+            for i, branch in operators:
+                kinds = kinds | TPGParser.guard(branch, self.firsts)
+            code.append([
+                tab + "while True:",
+                tab + tab + "%s = _lexer.cur_token"%p,
+                tab + tab + "if %s:"%TPGParser.gen_kind_test(p, kinds),
+                [ self.gen_branch(tab+tab+tab, counters, p, test(n and "elif" or "if", p, i, branch), i, branch,
+                                  self.levels[i][0], lambda indent: indent + "continue")
+                  for n, (i, branch) in enumerate(operators) ],
+                tab + tab + tab + "_lexer.back(%s)"%p,
+                tab + tab + "break",
+                tab + "return %s"%self.acc,
+            ])
+            return self.name, code
+
+    class Climb(NotEmpty):
+        """ call of a precedence climbing routine from a level """
+        def __init__(self, name, level, ret):
+            self.name = name
+            self.level = level
+            self.ret = ret
+        def gen_code(self, indent, counters, pos, k):
+            call = "self.%s(%d)"%(self.name, self.level)
+            if self.ret is not None:
+                call = "%s = %s"%(self.ret.gen_code(), call)
+            return [
+                indent + "try:",
+                indent + tab + call,
+                indent + "except tpg.WrongToken:",
+                indent + tab + "pass",
+                indent + "else:",
+                k(indent+tab),
             ]
 
     class Symbol(NotEmpty):
@@ -1895,23 +2455,35 @@ class TPGParser(tpg.Parser):
             self.token = tokens.get(self.name, None)
             if self.token is not None and self.args:
                 raise SemanticError("Token %s can not have arguments"%self.name)
+        def first(self, firsts):
+            if self.token is not None:
+                return frozenset([getattr(self.token, 'explicit_token', self.token).kind]), False
+            # a rule defined outside the grammar may start with anything
+            return firsts.get(self.name, (None, True))
         def gen_def(self):
             return "def %s(self, %s):"%(self.name, self.args.gen_code())
         def gen_init_ret(self, indent):
             return self.ret.gen_code() == self.name and indent + "%s = None"%(self.name) or ()
         def gen_ret(self, indent):
             return self.ret and indent + "return %s"%self.ret.gen_code() or ()
-        def gen_code(self, indent, counters, pos):
+        def gen_code(self, indent, counters, pos, k):
             if self.token is not None:
-                if self.ret is not None:
-                    return indent + "%s = self.eat('%s')"%(self.ret.gen_code(), self.token.name)
-                else:
-                    return indent + "self.eat('%s')"%(self.token.name)
+                return TPGParser.gen_eat(indent, counters, self.token, self.ret, k, pos=pos)
+            elif self.name in counters.inlines and not self.args:
+                return counters.inlines[self.name].inline(self.ret).gen_code(indent, counters, pos, k)
             else:
                 if self.ret is not None:
-                    return indent + "%s = self.%s(%s)"%(self.ret.gen_code(), self.name, self.args.gen_code())
+                    call = "%s = self.%s(%s)"%(self.ret.gen_code(), self.name, self.args.gen_code())
                 else:
-                    return indent + "self.%s(%s)"%(self.name, self.args.gen_code())
+                    call = "self.%s(%s)"%(self.name, self.args.gen_code())
+                return [
+                    indent + "try:",
+                    indent + tab + call,
+                    indent + "except tpg.WrongToken:",
+                    indent + tab + "pass",
+                    indent + "else:",
+                    k(indent+tab),
+                ]
         def gen_doc(self, parent):
             return self.name
 
@@ -1927,11 +2499,10 @@ class TPGParser(tpg.Parser):
             return self.explicit_token.gen_def()
         def links_symbols_to_tokens(self, tokens):
             pass
-        def gen_code(self, indent, counters, pos):
-            if self.ret is not None:
-                return indent + "%s = self.eat('%s') # %s"%(self.ret.gen_code(), self.explicit_token.name, self.expr)
-            else:
-                return indent + "self.eat('%s') # %s"%(self.explicit_token.name, self.expr)
+        def first(self, firsts):
+            return frozenset([self.explicit_token.kind]), False
+        def gen_code(self, indent, counters, pos, k):
+            return TPGParser.gen_eat(indent, counters, self, self.ret, k, " # %s"%self.expr, pos)
         def gen_doc(self, parent):
             return self.expr
 
@@ -1977,11 +2548,43 @@ class TPGParser(tpg.Parser):
         def links_symbols_to_tokens(self, tokens):
             for a in self:
                 a.links_symbols_to_tokens(tokens)
-        def gen_code(self, indent, counters, pos):
-            return self and [
-                self[0].gen_code(indent, counters, pos),
-                [a.gen_code(indent, counters, None) for a in self[1:]],
+        def first(self, firsts):
+            kinds = frozenset()
+            for a in self:
+                a_kinds, a_nullable = a.first(firsts)
+                kinds = TPGParser.first_union(kinds, a_kinds)
+                if not a_nullable:
+                    return kinds, False
+            return kinds, True
+        chunk = 8       # elements nested in each other's continuations
+        def gen_code(self, indent, counters, pos, k):
+            # Each element runs the next one when it matches, so the code
+            # of a sequence nests one level deeper per element. Long
+            # sequences are cut into chunks recording their success in a
+            # flag, the next chunk being run at the same level if it is set.
+            def seq(i, end, pos, k):
+                if i == end:
+                    return k
+                return lambda indent: self[i].gen_code(indent, counters, pos, seq(i+1, end, None, k))
+            if len(self) <= self.chunk:
+                return seq(0, len(self), pos, k)(indent)
+            ok = counters("ok")
+            matched = lambda indent: indent + "%s = True"%ok
+            code = [
+                indent + "%s = False"%ok,
+                seq(0, self.chunk, pos, matched)(indent),
             ]
+            for i in range(self.chunk, len(self), self.chunk):
+                code.extend([
+                    indent + "if %s:"%ok,
+                    indent + tab + "%s = False"%ok,
+                    seq(i, min(i+self.chunk, len(self)), None, matched)(indent+tab),
+                ])
+            code.extend([
+                indent + "if %s:"%ok,
+                k(indent+tab),
+            ])
+            return code
         def gen_doc(self, parent):
             docs = []
             for a in self:
@@ -1991,39 +2594,156 @@ class TPGParser(tpg.Parser):
             return " ".join(docs)
 
     class Or(NotEmpty):
-        def __init__(self, a, b):
-            self.a = a
-            self.b = b
+        def __init__(self, alternatives):
+            self.alternatives = alternatives
         def get_inline_tokens(self):
-            for token in self.a.get_inline_tokens():
-                yield token
-            for token in self.b.get_inline_tokens():
-                yield token
+            for a in self.alternatives:
+                for token in a.get_inline_tokens():
+                    yield token
         def links_symbols_to_tokens(self, tokens):
-            self.a.links_symbols_to_tokens(tokens)
-            self.b.links_symbols_to_tokens(tokens)
-        def gen_code(self, indent, counters, pos):
+            for a in self.alternatives:
+                a.links_symbols_to_tokens(tokens)
+        def first(self, firsts):
+            kinds, nullable = frozenset(), False
+            for a in self.alternatives:
+                a_kinds, a_nullable = a.first(firsts)
+                kinds = TPGParser.first_union(kinds, a_kinds)
+                nullable = nullable or a_nullable
+            return kinds, nullable
+        def gen_code(self, indent, counters, pos, k):
+            # The alternatives are tried in turn from the same saved token p.
+            # When the first kinds of an alternative are known, it is only
+            # tried if p is of one of them, and a rewind is only needed if
+            # a previous alternative may have consumed tokens.
             p = pos or counters("p")
-            return [
-                pos is None and indent + "%s = self.lexer.token()"%p or (),
-                indent + "try:",
-                self.a.gen_code(indent+tab, counters, p),
-                indent + "except tpg.WrongToken:",
-                indent + tab + "self.lexer.back(%s)"%p,
-                self.b.gen_code(indent+tab, counters, p),
+            ok = counters("ok")
+            matched = lambda indent: indent + "%s = True"%ok
+            code = [
+                pos is None and indent + "%s = _lexer.cur_token"%p or (),
+                indent + "%s = False"%ok,
             ]
+            tried = []          # first kinds of the previous alternatives
+            chained = False     # the previous alternative is under an if
+            for a in self.alternatives:
+                kinds = counters.eat == 'inline' and TPGParser.guard(a, counters.firsts) or None
+                overlap = [t for t in tried if t is None or kinds is None or t & kinds]
+                if kinds is not None:
+                    test = TPGParser.gen_kind_test(p, kinds)
+                if not tried and kinds is None:
+                    code.append(a.gen_code(indent, counters, p, matched))
+                    chained = False
+                else:
+                    if not overlap:
+                        code.append(indent + "%s %s:"%(chained and "elif" or "if", test))
+                    elif kinds is None:
+                        code.append(indent + "if not %s:"%ok)
+                    else:
+                        code.append(indent + "if not %s and %s:"%(ok, test))
+                    code.append([
+                        overlap and indent + tab + "_lexer.back(%s)"%p or (),
+                        TPGParser.gen_known(a, indent+tab, counters, p, kinds or counters.known.get(p), matched),
+                    ])
+                    chained = True
+                tried.append(kinds)
+            code.append([
+                indent + "if %s:"%ok,
+                k(indent+tab),
+            ])
+            return code
         def gen_doc(self, parent):
-            doc = "%s | %s"%(self.a.gen_doc(self), self.b.gen_doc(self))
+            doc = " | ".join([a.gen_doc(self) for a in self.alternatives])
             if isinstance(parent, TPGParser.And) and len(parent) > 1:
                 doc = "(%s)"%doc
             return doc
 
-    def balance(self, xs):
+    def alternatives(self, xs):
+        xs = self.factor(xs)
         if len(xs) == 1:
             return xs[0]
         else:
-            m = len(xs)//2
-            return self.Or(self.balance(xs[:m]), self.balance(xs[m:]))
+            return self.Or(xs)
+
+    def factor(self, xs):
+        """ factor the prefix shared by adjacent alternatives:
+        A B | A C | D becomes A (B | C) | D
+
+        Only symbols, tokens and marks are factored; the alternatives are
+        not reordered, so the first alternative matching still wins. """
+        def elements(x):
+            return isinstance(x, self.And) and list(x) or [x]
+        def prefix(a, b):
+            n = 0
+            while n < len(a) and n < len(b) and self.same(a[n], b[n]):
+                n += 1
+            return n
+        groups = []
+        for x in xs:
+            if groups and prefix(elements(groups[-1][0]), elements(x)):
+                groups[-1].append(x)
+            else:
+                groups.append([x])
+        factored = []
+        for group in groups:
+            if len(group) == 1:
+                factored.append(group[0])
+            else:
+                first = elements(group[0])
+                n = min([prefix(first, elements(x)) for x in group])
+                rests = [self.And(elements(x)[n:]) for x in group]
+                factored.append(self.And(first[:n] + [self.alternatives(rests)]))
+        return factored
+
+    @staticmethod
+    def same(a, b):
+        """ tell whether a and b match the same text and bind the same names """
+        def code(x):
+            return x is not None and x.gen_code() or None
+        if type(a) is not type(b):
+            return False
+        elif isinstance(a, TPGParser.Symbol):
+            return a.name == b.name and a.args.gen_code() == b.args.gen_code() and code(a.ret) == code(b.ret)
+        elif isinstance(a, TPGParser.InlineToken):
+            return a.expr[1:-1] == b.expr[1:-1] and code(a.ret) == code(b.ret)
+        elif isinstance(a, TPGParser.Mark):
+            return code(a.mark) == code(b.mark)
+        return False
+
+    @staticmethod
+    def first_union(a, b):
+        """ union of two sets of first kinds, None standing for any kind """
+        if a is None or b is None:
+            return None
+        return a | b
+
+    @staticmethod
+    def guard(expr, firsts):
+        """ return the kinds a match of expr starts with, or None if unknown
+        or if expr may match the empty string """
+        kinds, nullable = expr.first(firsts)
+        if nullable or not kinds:
+            return None
+        return kinds
+
+    @staticmethod
+    def gen_known(expr, indent, counters, p, kinds, k):
+        """ generate the code of expr starting at the token p, known to be
+        of one of kinds (None if unknown) while p is the current token """
+        known = counters.known.get(p)
+        counters.known[p] = kinds
+        try:
+            return expr.gen_code(indent, counters, p, k)
+        finally:
+            counters.known[p] = known
+
+    @staticmethod
+    def gen_kind_test(token, kinds):
+        kinds = sorted(kinds)
+        if len(kinds) == 1:
+            return "%s.kind == %d"%(token, kinds[0])
+        elif len(kinds) <= 3:
+            return "%s.kind in (%s)"%(token, ", ".join(["%d"%k for k in kinds]))
+        else:
+            return "%s.kind in {%s}"%(token, ", ".join(["%d"%k for k in kinds]))
 
     class Rep(NotEmpty):
         def __init__(self, a, min, max):
@@ -2035,28 +2755,37 @@ class TPGParser(tpg.Parser):
                 yield token
         def links_symbols_to_tokens(self, tokens):
             self.a.links_symbols_to_tokens(tokens)
-        def gen_code(self, indent, counters, pos):
+        def first(self, firsts):
+            kinds, nullable = self.a.first(firsts)
+            min = self.min
+            if min not in (0, 1):
+                # a bound computed at parse time may be 0
+                min = min.gen_code()
+                min = min.isdigit() and int(min) or 0
+            return kinds, nullable or min == 0
+        def gen_code(self, indent, counters, pos, k):
             # A?
             if (self.min, self.max) == (0, 1):
                 p = pos or counters("p")
+                ok = counters("ok")
                 return [
-                    pos is None and indent + "%s = self.lexer.token()"%p or (),
-                    indent + "try:",
-                    self.a.gen_code(indent+tab, counters, p),
-                    indent + "except tpg.WrongToken:",
-                    indent + tab + "self.lexer.back(%s)"%p,
+                    pos is None and indent + "%s = _lexer.cur_token"%p or (),
+                    indent + "%s = False"%ok,
+                    self.a.gen_code(indent, counters, p, lambda indent: indent + "%s = True"%ok),
+                    indent + "if not %s:"%ok,
+                    indent + tab + "_lexer.back(%s)"%p,
+                    k(indent),
                 ]
             # A*
             elif (self.min, self.max) == (0, None):
                 p = pos or counters("p")
                 return [
                     indent + "while True:",
-                    indent + tab + "%s = self.lexer.token()"%p,
-                    indent + tab + "try:",
-                    self.a.gen_code(indent+tab+tab, counters, p),
-                    indent + tab + "except tpg.WrongToken:",
-                    indent + tab + tab + "self.lexer.back(%s)"%p,
-                    indent + tab + tab + "break",
+                    indent + tab + "%s = _lexer.cur_token"%p,
+                    TPGParser.gen_known(self.a, indent+tab, counters, p, None, lambda indent: indent + "continue"),
+                    indent + tab + "_lexer.back(%s)"%p,
+                    indent + tab + "break",
+                    k(indent),
                 ]
             # A+
             elif (self.min, self.max) == (1, None):
@@ -2065,14 +2794,12 @@ class TPGParser(tpg.Parser):
                 return [
                     indent + "%s = 0"%n,
                     indent + "while True:",
-                    indent + tab + "%s = self.lexer.token()"%p,
-                    indent + tab + "try:",
-                    self.a.gen_code(indent+tab+tab, counters, p),
-                    indent + tab + tab + "%s += 1"%n,
-                    indent + tab + "except tpg.WrongToken:",
-                    indent + tab + tab + "if %s < 1: raise"%n,
-                    indent + tab + tab + "self.lexer.back(%s)"%p,
-                    indent + tab + tab + "break",
+                    indent + tab + "%s = _lexer.cur_token"%p,
+                    TPGParser.gen_known(self.a, indent+tab, counters, p, None, lambda indent: [indent + "%s += 1"%n, indent + "continue"]),
+                    indent + tab + "_lexer.back(%s)"%p,
+                    indent + tab + "break",
+                    indent + "if %s >= 1:"%n,
+                    k(indent+tab),
                 ]
             # A{min, max}
             else:
@@ -2083,14 +2810,12 @@ class TPGParser(tpg.Parser):
                 return [
                     indent + "%s = 0"%n,
                     indent + "while %s:"%(max=="None" and "True" or "%s < %s"%(n, max)),
-                    indent + tab + "%s = self.lexer.token()"%p,
-                    indent + tab + "try:",
-                    self.a.gen_code(indent+tab+tab, counters, p),
-                    indent + tab + tab + "%s += 1"%n,
-                    indent + tab + "except tpg.WrongToken:",
-                    indent + tab + tab + "if %s < %s: raise"%(n, min),
-                    indent + tab + tab + "self.lexer.back(%s)"%p,
-                    indent + tab + tab + "break",
+                    indent + tab + "%s = _lexer.cur_token"%p,
+                    TPGParser.gen_known(self.a, indent+tab, counters, p, None, lambda indent: [indent + "%s += 1"%n, indent + "continue"]),
+                    indent + tab + "_lexer.back(%s)"%p,
+                    indent + tab + "break",
+                    indent + "if %s >= %s:"%(n, min),
+                    k(indent+tab),
                 ]
         def gen_doc(self, parent):
             doc = self.a.gen_doc(self)
@@ -2119,12 +2844,17 @@ class TPGParser(tpg.Parser):
         def get_inline_tokens(self):
             return
             yield None
+        def first(self, firsts):
+            return frozenset(), True
         def links_symbols_to_tokens(self, tokens):
             pass
         def gen_doc(self, parent):
             return ""
-        def gen_code(self, indent, counters, pos):
-            return indent + "self.check(%s)"%self.cond.gen_code()
+        def gen_code(self, indent, counters, pos, k):
+            return [
+                indent + "if %s:"%self.cond.gen_code(),
+                k(indent+tab),
+            ]
 
     class Error(NotEmpty):
         def __init__(self, msg):
@@ -2132,11 +2862,13 @@ class TPGParser(tpg.Parser):
         def get_inline_tokens(self):
             return
             yield None
+        def first(self, firsts):
+            return frozenset(), True
         def links_symbols_to_tokens(self, tokens):
             pass
         def gen_doc(self, parent):
             return ""
-        def gen_code(self, indent, counters, pos):
+        def gen_code(self, indent, counters, pos, k):
             return indent + "self.error(%s)"%self.msg.gen_code()
 
     class Mark(NotEmpty):
@@ -2145,12 +2877,71 @@ class TPGParser(tpg.Parser):
         def get_inline_tokens(self):
             return
             yield None
+        def first(self, firsts):
+            return frozenset(), True
         def links_symbols_to_tokens(self, tokens):
             pass
         def gen_doc(self, parent):
             return ""
-        def gen_code(self, indent, counters, pos):
-            return indent + "%s = self.mark()"%self.mark.gen_code()
+        def gen_code(self, indent, counters, pos, k):
+            return [
+                indent + "%s = self.mark()"%self.mark.gen_code(),
+                k(indent),
+            ]
+
+    @staticmethod
+    def gen_locals(indent, code):
+        """ bind the lexer to a local variable if code uses it """
+        def uses_lexer(code):
+            if isinstance(code, (list, tuple)):
+                for line in code:
+                    if uses_lexer(line):
+                        return True
+                return False
+            return "_lexer." in code
+        return uses_lexer(code) and indent + "_lexer = self.lexer" or ()
+
+    @staticmethod
+    def gen_eat(indent, counters, token, ret, k, comment="", pos=None):
+        """ generate the code matching token, running k when it matches
+
+        With counters.eat set to 'inline', the kind of the current token is
+        tested in place, unless a guard already tested it (see gen_known);
+        'accept' asks a context sensitive lexer for a token of the kind;
+        'eat' calls self.eat, which verbose parsers trace.
+        """
+        token = getattr(token, 'explicit_token', token)
+        ret = ret is not None and ret.gen_code() + " = " or ""
+        if counters.eat == 'inline' and pos is not None and counters.known.get(pos) == frozenset([token.kind]):
+            return [
+                indent + "_lexer.next_token()%s"%comment,
+                ret and indent + "%s%s.value"%(ret, pos) or (),
+                k(indent),
+            ]
+        if counters.eat == 'eat':
+            return [
+                indent + "try:",
+                indent + tab + "%sself.eat('%s')%s"%(ret, token.name, comment),
+                indent + "except tpg.WrongToken:",
+                indent + tab + "pass",
+                indent + "else:",
+                k(indent+tab),
+            ]
+        elif counters.eat == 'accept':
+            return [
+                indent + "_tok = _lexer.accept(%d)%s"%(token.kind, comment),
+                indent + "if _tok is not None:",
+                ret and indent + tab + "%s_tok.value"%ret or (),
+                k(indent+tab),
+            ]
+        else:
+            return [
+                indent + "_tok = _lexer.cur_token",
+                indent + "if _tok.kind == %d:%s"%(token.kind, comment),
+                indent + tab + "_lexer.next_token()",
+                ret and indent + tab + "%s_tok.value"%ret or (),
+                k(indent+tab),
+            ]
 
     class PY_Ident(str):
         def gen_code(self):
@@ -2191,6 +2982,9 @@ class TPGParser(tpg.Parser):
                 token.set_explicit_token(self.DefToken("_tok_%s"%token_number, self.string_prefix, token.expr))
                 explicit_tokens[token.expr[1:-1]] = token.explicit_token
                 inline_tokens.append(token)
+        # token kinds, 0 being the end of file
+        for kind, tok in enumerate([tok.explicit_token for tok in inline_tokens] + list(tokens)):
+            tok.kind = kind + 1
         yield self.make_code("init_lexer",
             "def init_lexer(self):",
             lexer is ContextSensitiveLexer and [tab + "self.eat = self.eatCSL"] or (),
@@ -2206,6 +3000,12 @@ class TPGParser(tpg.Parser):
         for token in tokens:
             tokens_from_name[token.name] = token
         rules.links_symbols_to_tokens(tokens_from_name)
-        for name, code in rules.gen_code():
+        if getattr(self, 'verbose', False):
+            eat = 'eat'
+        elif lexer is ContextSensitiveLexer:
+            eat = 'accept'
+        else:
+            eat = 'inline'
+        for name, code in rules.gen_code(eat):
             yield self.make_code(name, *code)
 